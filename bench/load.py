@@ -0,0 +1,350 @@
+"""Replay a requests.jsonl-style trace against control_api.py and search.py.
+
+Reports p50/p95/p99 latency per route, throughput and peak RSS of the
+services (engines included), saves the run as JSON and optionally compares it
+with a previous run, exiting non-zero on a regression:
+
+    python bench/load.py --spawn --concurrency 8 --requests 500 --output run.json
+    python bench/load.py --spawn --output new.json --compare run.json
+
+With --spawn both services are started here on the fake engine and the stub
+search backend; otherwise --control/--search must point at running services.
+"""
+import argparse
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import psutil
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SEARCH_ROUTES = ('/search', '/ace/manifest.m3u8')
+POST_ROUTES = ('/start', '/start_stream', '/stop_stream', '/refresh_inventory', '/start_daemon')
+# Long-lived streams would never finish; they are not replayable as requests.
+SKIP_PREFIXES = ('/relay/', '/jobs/')
+RECORD_KEYS = ('request_id', 'timestamp', 'route')
+
+
+def load_trace(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get('route', '').startswith(SKIP_PREFIXES):
+                continue
+            # Without an id /stop_stream stops every engine on the host.
+            if record.get('route') == '/stop_stream' and not record.get('stream_id'):
+                continue
+            records.append(record)
+    if not records:
+        raise SystemExit('empty trace: %s' % path)
+    return records
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(samples, elapsed):
+    latencies = [s['latency'] for s in samples]
+    return {
+        'count': len(samples),
+        'errors': sum(1 for s in samples if s['error']),
+        'throughput': round(len(samples) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'bytes': sum(s['bytes'] for s in samples),
+    }
+
+
+class Replayer(object):
+    def __init__(self, records, control, search, timeout):
+        self.records = itertools.cycle(records)
+        self.control = control.rstrip('/')
+        self.search = search.rstrip('/')
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.samples = []
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def next_record(self):
+        with self.lock:
+            return next(self.records)
+
+    def send(self, record):
+        route = record['route']
+        fields = {k: v for k, v in record.items() if k not in RECORD_KEYS}
+        base = self.search if route.startswith(SEARCH_ROUTES) else self.control
+        started = time.monotonic()
+        size, error = 0, None
+        try:
+            if route in POST_ROUTES:
+                response = self.session().post(base + route, json=fields, timeout=self.timeout, stream=True)
+            else:
+                response = self.session().get(base + route, params=fields, timeout=self.timeout, stream=True)
+            with response:
+                for chunk in response.iter_content(65536):
+                    size += len(chunk)
+            if response.status_code >= 500:
+                error = 'HTTP %d' % response.status_code
+        except requests.RequestException as e:
+            error = type(e).__name__
+        sample = {'route': route, 'latency': time.monotonic() - started, 'bytes': size, 'error': error}
+        with self.lock:
+            self.samples.append(sample)
+
+    def worker(self, deadline, remaining):
+        while time.monotonic() < deadline:
+            with self.lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            self.send(self.next_record())
+
+
+def listening_pid(url):
+    port = urlparse(url).port or 80
+    for conn in psutil.net_connections('tcp'):
+        if conn.status == psutil.CONN_LISTEN and conn.laddr.port == port and conn.pid:
+            return conn.pid
+    return None
+
+
+class RssSampler(threading.Thread):
+    """Track peak and last RSS of each service plus its engine children."""
+
+    def __init__(self, pids, interval=0.5):
+        super(RssSampler, self).__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.stats = {name: {'peak_mb': 0.0, 'last_mb': 0.0} for name in pids}
+        self.stats['engines'] = {'peak_mb': 0.0, 'last_mb': 0.0, 'peak_count': 0}
+        self.stopped = threading.Event()
+
+    def sample(self):
+        engines, engine_count = 0, 0
+        for name, pid in self.pids.items():
+            try:
+                process = psutil.Process(pid)
+                rss = process.memory_info().rss
+                children = process.children(recursive=True)
+            except psutil.Error:
+                continue
+            for child in children:
+                try:
+                    if 'acestream' in child.name().lower():
+                        engines += child.memory_info().rss
+                        engine_count += 1
+                except psutil.Error:
+                    continue
+            stats = self.stats[name]
+            stats['last_mb'] = round(rss / 1048576.0, 1)
+            stats['peak_mb'] = max(stats['peak_mb'], stats['last_mb'])
+        stats = self.stats['engines']
+        stats['last_mb'] = round(engines / 1048576.0, 1)
+        stats['peak_mb'] = max(stats['peak_mb'], stats['last_mb'])
+        stats['peak_count'] = max(stats['peak_count'], engine_count)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=2)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    return False
+
+
+def spawn_services(args):
+    control_port = urlparse(args.control).port
+    search_port = urlparse(args.search).port
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(control_port),
+        'ACESTREAM_BINARY': os.path.join(BENCH_DIR, 'fake_acestreamengine'),
+        'ACESTREAM_PORTS': args.engine_ports,
+        'REQUEST_LOG_FILE': os.path.join(args.workdir, 'requests.jsonl'),
+        'CHANNEL_INDEX_DB': os.path.join(args.workdir, 'channels.db'),
+        'REGISTRY_FILE': os.path.join(args.workdir, 'registry.json'),
+        'TRACE_FILE': os.path.join(args.workdir, 'traces.jsonl'),
+        'PYTHONPATH': os.pathsep.join(filter(None, [os.path.join(BENCH_DIR, 'stubs'), env.get('PYTHONPATH')])),
+        'ENGINE_URL': 'http://127.0.0.1:%s' % args.engine_ports.split('-')[0],
+    })
+    log = open(os.path.join(args.workdir, 'services.log'), 'a')
+    control = subprocess.Popen([sys.executable, 'control_api.py'], cwd=REPO_DIR, env=env,
+                               stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    search = subprocess.Popen([sys.executable, '-c', 'import search; search.app.run(host="127.0.0.1", port=%d, '
+                               'threaded=True)' % search_port], cwd=REPO_DIR, env=env,
+                              stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    processes = {'control_api': control, 'search': search}
+    if not (wait_until_up(args.control + '/health') and wait_until_up(args.search + '/metrics')):
+        stop_services(processes)
+        raise SystemExit('services did not come up, see %s' % log.name)
+    return processes
+
+
+def stop_services(processes):
+    # Engines run in their own sessions; stop the ones our services spawned, and only those.
+    children = []
+    for process in processes.values():
+        try:
+            children.extend(psutil.Process(process.pid).children(recursive=True))
+        except psutil.Error:
+            pass
+    for child in children:
+        try:
+            child.terminate()
+        except psutil.Error:
+            pass
+    psutil.wait_procs(children, timeout=5, callback=None)
+    for child in children:
+        try:
+            child.kill()
+        except psutil.Error:
+            pass
+    for process in processes.values():
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for process in processes.values():
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def compare(current, baseline, tolerance):
+    """Return human-readable regressions of current against baseline."""
+    regressions = []
+    for route, base in sorted(baseline.get('routes', {}).items()):
+        now = current['routes'].get(route)
+        if not now or not base.get('p95_ms') or now.get('p95_ms') is None:
+            continue
+        if now['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append('%s p95 %.1fms -> %.1fms' % (route, base['p95_ms'], now['p95_ms']))
+    base_tp = baseline.get('overall', {}).get('throughput')
+    now_tp = current['overall']['throughput']
+    if base_tp and now_tp is not None and now_tp < base_tp * (1 - tolerance):
+        regressions.append('throughput %.1f/s -> %.1f/s' % (base_tp, now_tp))
+    for name, base in baseline.get('rss', {}).items():
+        now = current['rss'].get(name)
+        if now and base.get('peak_mb') and now['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+            regressions.append('%s peak RSS %.1fMB -> %.1fMB' % (name, base['peak_mb'], now['peak_mb']))
+    return regressions
+
+
+def report(result):
+    print('%-28s %7s %6s %9s %9s %9s' % ('route', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    rows = sorted(result['routes'].items()) + [('TOTAL', result['overall'])]
+    for route, stats in rows:
+        print('%-28s %7d %6d %9s %9s %9s' % (route[:28], stats['count'], stats['errors'],
+                                             stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+    print('throughput: %s req/s over %.1fs' % (result['overall']['throughput'], result['elapsed']))
+    for name, stats in sorted(result['rss'].items()):
+        print('rss %-12s peak %6.1f MB  last %6.1f MB' % (name, stats['peak_mb'], stats['last_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--trace', default=os.path.join(BENCH_DIR, 'trace.jsonl'))
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=200, help='total requests (trace is cycled)')
+    parser.add_argument('--duration', type=float, default=300, help='stop after this many seconds')
+    parser.add_argument('--timeout', type=float, default=60, help='per-request timeout')
+    parser.add_argument('--control', default='http://127.0.0.1:18080')
+    parser.add_argument('--search', default='http://127.0.0.1:18088')
+    parser.add_argument('--spawn', action='store_true', help='start both services on the fake backends')
+    parser.add_argument('--engine-ports', default='16878-16885', help='ACESTREAM_PORTS for spawned services')
+    parser.add_argument('--workdir', default='/tmp/acestream-bench')
+    parser.add_argument('--output', help='write the result as JSON')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+    os.makedirs(args.workdir, exist_ok=True)
+    processes = spawn_services(args) if args.spawn else {}
+    try:
+        pids = {name: p.pid for name, p in processes.items()} or {
+            name: pid for name, pid in (('control_api', listening_pid(args.control)),
+                                        ('search', listening_pid(args.search))) if pid}
+        sampler = RssSampler(pids)
+        sampler.start()
+        replayer = Replayer(records, args.control, args.search, args.timeout)
+        started = time.monotonic()
+        deadline = started + args.duration
+        remaining = [args.requests]
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            for _ in range(args.concurrency):
+                pool.submit(replayer.worker, deadline, remaining)
+        elapsed = time.monotonic() - started
+        sampler.sample()
+        sampler.stopped.set()
+        stream_ids = sorted({r['stream_id'] for r in records if r.get('stream_id')})
+        if processes and stream_ids:
+            try:
+                requests.post(args.control + '/stop_streams', json={'stream_ids': stream_ids}, timeout=30)
+            except requests.RequestException:
+                pass
+    finally:
+        if processes:
+            stop_services(processes)
+
+    by_route = {}
+    for sample in replayer.samples:
+        by_route.setdefault(sample['route'], []).append(sample)
+    result = {
+        'started_at': time.time() - elapsed,
+        'elapsed': round(elapsed, 3),
+        'config': {'trace': args.trace, 'concurrency': args.concurrency, 'requests': args.requests,
+                   'spawned': args.spawn},
+        'overall': summarize(replayer.samples, elapsed),
+        'routes': {route: summarize(samples, elapsed) for route, samples in by_route.items()},
+        'rss': sampler.stats,
+    }
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION: ' + line)
+        if regressions:
+            return 1
+        print('no regressions against %s' % args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Stub of acestream_search producing the same output shapes from synthetic data.
+
+Environment:
+    BENCH_SEARCH_RESULTS    channels in the synthetic catalogue (500)
+    BENCH_SEARCH_PAGE_SIZE  results per page (200)
+    BENCH_SEARCH_LATENCY    seconds spent per page, like an API round trip (0.05)
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+from . import __version__  # noqa: F401 (re-exported for search.py)
+
+CATEGORIES = ('news', 'sport', 'movies', 'music', 'kids')
+
+
+def get_options(args={}):
+    opts = argparse.Namespace(query='', quiet=False, name=None, category='', proxy='localhost:6878',
+                              target='localhost:6878', page_size=int(os.environ.get('BENCH_SEARCH_PAGE_SIZE', 200)),
+                              group_by_channels=False, show_epg=False, show_category=False, json=False,
+                              xml_epg=False, debug=False, url=False, after=0, prog=args.get('prog'))
+    opts.__dict__.update(args)
+    if opts.show_epg or opts.xml_epg:
+        opts.show_epg = 1
+        opts.group_by_channels = 1
+    if 'help' in args:
+        opts.help = 'usage: %s [options] [query]\n' % opts.prog
+    if 'usage' in args:
+        opts.usage = 'usage: %s [options] [query]\n' % opts.prog
+    return opts
+
+
+def catalogue(args):
+    size = int(os.environ.get('BENCH_SEARCH_RESULTS', 500))
+    query = (args.query or '').lower()
+    names = args.name or None
+    now = int(time.time())
+    for i in range(size):
+        name = 'Channel %d %s' % (i, CATEGORIES[i % len(CATEGORIES)])
+        if query and query not in name.lower() or names and name not in names:
+            continue
+        yield {'name': name, 'infohash': '%040x' % (i + 1), 'channel_id': i, 'availability': 1.0,
+               'availability_updated_at': now, 'categories': [CATEGORIES[i % len(CATEGORIES)]],
+               'epg': [{'name': 'Programme %d' % i, 'start': now - now % 3600, 'stop': now - now % 3600 + 3600}]}
+
+
+def pages(args):
+    latency = float(os.environ.get('BENCH_SEARCH_LATENCY', 0.05))
+    page = []
+    for item in catalogue(args):
+        page.append(item)
+        if len(page) >= args.page_size:
+            time.sleep(latency)
+            yield page
+            page = []
+    time.sleep(latency)
+    if page:
+        yield page
+
+
+def xmltv(item):
+    start = datetime.fromtimestamp(item['epg'][0]['start'], timezone.utc).strftime('%Y%m%d%H%M%S')
+    stop = datetime.fromtimestamp(item['epg'][0]['stop'], timezone.utc).strftime('%Y%m%d%H%M%S')
+    return ('  <channel id="%d">\n    <display-name lang="ru">%s</display-name>\n  </channel>\n'
+            '  <programme start="%s +0000" stop="%s +0000" channel="%d">\n'
+            '    <title lang="ru">%s</title>\n  </programme>\n'
+            % (item['channel_id'], item['name'], start, stop, item['channel_id'], item['epg'][0]['name']))
+
+
+def playlist(args, item, number):
+    url = 'http://%s/ace/getstream?infohash=%s' % (args.target, item['infohash'])
+    if args.url:
+        return url
+    title = '#EXTINF:-1'
+    if args.show_epg:
+        title += ' tvg-id="%d"' % item['channel_id']
+    return '%s,%d. %s\n%s\n' % (title, number, item['name'], url)
+
+
+def main(args):
+    if args.xml_epg:
+        yield '<?xml version="1.0" encoding="utf-8" ?>\n<tv>'
+    elif args.json:
+        yield '['
+    elif not args.url:
+        yield '#EXTM3U'
+    number = 0
+    for page in pages(args):
+        if args.json:
+            groups = [{'name': item['name'], 'items': [item]} for item in page]
+            yield json.dumps(groups, ensure_ascii=False, indent=4).strip('[]\n') + ','
+        elif args.xml_epg:
+            for item in page:
+                yield xmltv(item)
+        else:
+            m3u = ''
+            for item in page:
+                number += 1
+                m3u += playlist(args, item, number)
+                if args.url:
+                    yield m3u
+                    return
+            yield m3u.strip('\n')
+    if args.xml_epg:
+        yield '</tv>'
+    elif args.json:
+        yield '    {\n    }\n]'
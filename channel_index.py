@@ -0,0 +1,182 @@
+"""Local full-text channel index (SQLite FTS5) fed by a background catalogue crawl."""
+import difflib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+INDEX_DB = os.environ.get('CHANNEL_INDEX_DB', '/tmp/acestream_channels.db')
+CRAWL_INTERVAL = float(os.environ.get('CHANNEL_INDEX_INTERVAL', 1800))
+FUZZY_CUTOFF = float(os.environ.get('CHANNEL_INDEX_FUZZY_CUTOFF', 0.75))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS channels (
+    infohash TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    channel TEXT,
+    categories TEXT,
+    epg_id TEXT,
+    availability REAL,
+    digest TEXT,
+    seen_at REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5(name, channel, categories, infohash UNINDEXED);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = sqlite3.connect(INDEX_DB, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+    return conn
+
+
+def last_crawl():
+    row = connect().execute("SELECT value FROM meta WHERE key = 'crawled_at'").fetchone()
+    return float(row['value']) if row else None
+
+
+def parse_catalogue(pages):
+    """Flatten the engine's JSON output into one dict per stream."""
+    text = ''.join(pages)
+    try:
+        groups = json.loads(text)
+    except ValueError:
+        groups = []
+        for page in pages:
+            if page.strip():
+                groups.extend(json.loads(page))
+    for group in groups:
+        for item in group.get('items', []):
+            if not item.get('infohash'):
+                continue
+            categories = item.get('categories') or []
+            epg_id = item.get('channel_id', group.get('epg_id'))
+            yield {
+                'infohash': item['infohash'],
+                'name': item.get('name') or group.get('name', ''),
+                'channel': group.get('name') or item.get('name', ''),
+                'categories': ' '.join(categories) if isinstance(categories, list) else str(categories),
+                'epg_id': None if epg_id is None else str(epg_id),
+                'availability': item.get('availability') or 0,
+            }
+
+
+def update(rows):
+    """Upsert only changed rows and drop streams missing from this crawl.
+
+    Returns (changed, removed).
+    """
+    crawled_at = time.time()
+    changed = 0
+    with _write_lock:
+        conn = connect()
+        with conn:
+            for row in rows:
+                digest = hashlib.sha1(json.dumps(row, sort_keys=True).encode('utf8')).hexdigest()
+                current = conn.execute('SELECT digest FROM channels WHERE infohash = ?',
+                                       (row['infohash'],)).fetchone()
+                if current and current['digest'] == digest:
+                    conn.execute('UPDATE channels SET seen_at = ? WHERE infohash = ?',
+                                 (crawled_at, row['infohash']))
+                    continue
+                changed += 1
+                conn.execute('INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (row['infohash'], row['name'], row['channel'], row['categories'], row['epg_id'],
+                              row['availability'], digest, crawled_at))
+                conn.execute('DELETE FROM channels_fts WHERE infohash = ?', (row['infohash'],))
+                conn.execute('INSERT INTO channels_fts VALUES (?, ?, ?, ?)',
+                             (row['name'], row['channel'], row['categories'], row['infohash']))
+            stale = [r['infohash'] for r in conn.execute('SELECT infohash FROM channels WHERE seen_at < ?',
+                                                         (crawled_at,))]
+            for infohash in stale:
+                conn.execute('DELETE FROM channels WHERE infohash = ?', (infohash,))
+                conn.execute('DELETE FROM channels_fts WHERE infohash = ?', (infohash,))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('crawled_at', ?)", (str(crawled_at),))
+    return changed, len(stale)
+
+
+def crawl(fetch_catalogue):
+    started = time.time()
+    changed, removed = update(list(parse_catalogue(fetch_catalogue())))
+    logger.info('channel index crawl: %d changed, %d removed in %.1fs', changed, removed, time.time() - started)
+
+
+def crawler(fetch_catalogue):
+    while True:
+        try:
+            crawl(fetch_catalogue)
+        except Exception as e:
+            logger.error('channel index crawl failed: %s', e)
+        time.sleep(CRAWL_INTERVAL)
+
+
+def start_crawler(fetch_catalogue):
+    thread = threading.Thread(target=crawler, args=(fetch_catalogue,), daemon=True)
+    thread.start()
+    return thread
+
+
+def _fts_query(text):
+    tokens = [t.replace('"', '') for t in text.split()]
+    return ' '.join('"%s"*' % t for t in tokens if t)
+
+
+def search(query='', names=None):
+    """Streams matching query by prefix (or fuzzily), or exactly one of names."""
+    conn = connect()
+    columns = 'c.infohash, c.name, c.channel, c.categories, c.epg_id, c.availability'
+    if names:
+        marks = ','.join('?' * len(names))
+        return conn.execute('SELECT %s FROM channels c WHERE c.name IN (%s) OR c.channel IN (%s) '
+                            'ORDER BY c.channel, c.availability DESC' % (columns, marks, marks),
+                            list(names) * 2).fetchall()
+    if not query.strip():
+        return conn.execute('SELECT %s FROM channels c ORDER BY c.channel, c.availability DESC'
+                            % columns).fetchall()
+    match = _fts_query(query)
+    rows = conn.execute('SELECT %s FROM channels_fts f JOIN channels c ON c.infohash = f.infohash '
+                        'WHERE channels_fts MATCH ? ORDER BY f.rank, c.availability DESC' % columns,
+                        (match,)).fetchall() if match else []
+    if rows:
+        return rows
+    # Fuzzy fallback for misspellings: closest channel names.
+    channels = [r['channel'] for r in conn.execute('SELECT DISTINCT channel FROM channels')]
+    close = difflib.get_close_matches(query, channels, n=5, cutoff=FUZZY_CUTOFF)
+    return search(names=close) if close else []
+
+
+def render_m3u(rows, target, show_epg=False, group_by_channels=False, start=1, header=True):
+    if header:
+        yield '#EXTM3U\n'
+    if group_by_channels:
+        rows = sorted(rows, key=lambda r: r['channel'])
+    for number, row in enumerate(rows, start):
+        if show_epg and row['epg_id']:
+            head = '#EXTINF:-1 tvg-id="%s",%d. %s' % (row['epg_id'], number, row['name'])
+        else:
+            head = '#EXTINF:-1,%d. %s' % (number, row['name'])
+        if group_by_channels:
+            head = head.replace('#EXTINF:-1', '#EXTINF:-1 group-title="%s"' % row['channel'], 1)
+        yield '%s\nhttp://%s/ace/getstream?infohash=%s\n' % (head, target, row['infohash'])
+
+
+def render_json(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(row['channel'], []).append({
+            'name': row['name'], 'infohash': row['infohash'], 'categories': row['categories'].split(),
+            'channel_id': row['epg_id'], 'availability': row['availability']})
+    yield json.dumps([{'name': name, 'items': items} for name, items in groups.items()]) + '\n'
@@ -1,25 +1,146 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import subprocess
 import os
 import signal
+import stat
 import time
+import re
 import requests
 import psutil
 import logging
 import threading
 import json
+import socket
+import collections
+import concurrent.futures
+import itertools
+import heapq
+import uuid
+
+import metrics
+import tracing
+from request_log import log_request, read_requests
 
 # Configurar logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+metrics.instrument(app, 'acestream_control')
 
-# Almacenar PIDs activos
-active_streams = {}
+# Métricas del motor
+STREAM_TIME_TO_READY = metrics.Histogram('acestream_stream_time_to_ready_seconds',
+                                         'Time until an engine, the daemon or a daemon session is ready.',
+                                         ('kind', 'profile'),
+                                         buckets=(0.5, 1, 2, 3, 5, 10, 15, 20, 30, 45, 60))
+ENGINE_SPAWNS = metrics.Counter('acestream_engine_spawns_total', 'Engine processes spawned.',
+                                ('mode', 'profile'))
+STREAM_FAILURES = metrics.Counter('acestream_stream_failures_total', 'Stream starts that failed.', ('mode',))
+STREAM_FALLBACKS = metrics.Counter('acestream_stream_fallbacks_total',
+                                   'Times start_stream_alternative() was taken, by branch.', ('branch',))
+ACTIVE_STREAMS = metrics.Gauge('acestream_active_streams', 'Streams in the registry by state.', ('state',))
+PROFILE_STREAMS = metrics.Gauge('acestream_profile_streams', 'Ready streams by engine tuning profile.',
+                                ('profile',))
+ENGINE_CPU = metrics.Gauge('acestream_engine_cpu_percent', 'Engine CPU usage.', ('stream_id', 'pid'))
+ENGINE_RSS = metrics.Gauge('acestream_engine_rss_bytes', 'Engine resident memory.', ('stream_id', 'pid'))
+ENGINE_THREADS = metrics.Gauge('acestream_engine_threads', 'Engine thread count.', ('stream_id', 'pid'))
+ENGINE_FDS = metrics.Gauge('acestream_engine_open_fds', 'Engine open file descriptors.', ('stream_id', 'pid'))
+METRICS_SAMPLE_INTERVAL = float(os.environ.get('METRICS_SAMPLE_INTERVAL', 10))
 
-def find_acestream_binary():
-    """Buscar y devolver el path del binario principal de AceStream"""
+# Pool de motores: cada stream corre en su propio motor y puerto
+def parse_port_range(value):
+    """Convertir "6878-6885" o "6878,6880" en una lista de puertos"""
+    ports = []
+    for part in value.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            ports.extend(range(int(first), int(last) + 1))
+        elif part:
+            ports.append(int(part))
+    return ports
+
+ENGINE_PORTS = parse_port_range(os.environ.get('ACESTREAM_PORTS', '6878-6885'))
+POOL_SIZE = max(1, min(int(os.environ.get('ACESTREAM_POOL_SIZE', 4)), len(ENGINE_PORTS)))
+FAILED_STREAM_TTL = 300
+
+# Modo de motor: "pool" (un proceso por stream) o "daemon" (un único motor
+# supervisado con sesiones HTTP por stream y contador de referencias)
+ENGINE_MODE = os.environ.get('ACESTREAM_MODE', 'pool')
+DAEMON_PORT = int(os.environ.get('ACESTREAM_DAEMON_PORT', 6878))
+DAEMON_CHECK_INTERVAL = float(os.environ.get('ACESTREAM_DAEMON_CHECK_INTERVAL', 5))
+
+# Perfiles de ajuste del motor: nombre -> opciones de línea de comandos. Los
+# integrados se pueden ampliar o sustituir con JSON en ACESTREAM_PROFILES o en
+# el fichero ACESTREAM_PROFILES_FILE. "default" mantiene el comportamiento de siempre.
+BUILTIN_PROFILES = {
+    "default": {},
+    "low-latency": {"live-cache-type": "memory", "live-cache-size": 268435456, "live-buffer": 5,
+                    "log-level": "info"},
+    "low-memory": {"live-cache-type": "disk", "live-cache-size": 104857600, "live-buffer": 10,
+                   "max-connections": 50, "log-level": "error"},
+    "high-viewer-count": {"live-cache-type": "memory", "live-cache-size": 536870912, "live-buffer": 25,
+                          "max-connections": 500, "log-level": "warning"},
+}
+
+def load_engine_profiles():
+    profiles = {name: dict(flags) for name, flags in BUILTIN_PROFILES.items()}
+    sources = []
+    if os.environ.get('ACESTREAM_PROFILES_FILE'):
+        try:
+            with open(os.environ['ACESTREAM_PROFILES_FILE']) as f:
+                sources.append(f.read())
+        except OSError as e:
+            logger.error(f"No se pudo leer ACESTREAM_PROFILES_FILE: {str(e)}")
+    if os.environ.get('ACESTREAM_PROFILES'):
+        sources.append(os.environ['ACESTREAM_PROFILES'])
+    for source in sources:
+        try:
+            custom = json.loads(source)
+        except ValueError as e:
+            logger.error(f"Perfiles de motor inválidos: {str(e)}")
+            continue
+        for name, flags in custom.items():
+            if isinstance(flags, dict):
+                profiles[name] = flags
+    return profiles
+
+ENGINE_PROFILES = load_engine_profiles()
+DEFAULT_PROFILE = os.environ.get('ACESTREAM_PROFILE', 'default')
+DAEMON_PROFILE = os.environ.get('ACESTREAM_DAEMON_PROFILE', DEFAULT_PROFILE)
+
+def profile_flags(name, base=()):
+    """Opciones del perfil como argumentos, sustituyendo las de base con el mismo nombre"""
+    flags = ENGINE_PROFILES.get(name, {})
+    args = [arg for arg in base if arg.lstrip('-').split('=', 1)[0] not in flags]
+    for key, value in flags.items():
+        if value is True:
+            args.append(f"--{key}")
+        elif value not in (None, False):
+            args.append(f"--{key}={value}")
+    return args
+
+STATE_STARTING = 'starting'
+STATE_READY = 'ready'
+STATE_FAILED = 'failed'
+STATE_STOPPING = 'stopping'
+
+# Registro de streams activos en orden LRU (el primero es el menos usado).
+# Cada entrada es un dict; cualquier acceso debe hacerse con streams_lock.
+active_streams = collections.OrderedDict()
+streams_lock = threading.RLock()
+
+# Inventario del motor AceStream: se construye una vez y solo se invalida si
+# cambia el binario (mtime/inode) o se pide explícitamente con /refresh_inventory
+engine_inventory = {}
+inventory_lock = threading.Lock()
+
+def locate_acestream_binary():
+    """Buscar en disco el path del binario principal de AceStream (sin caché)"""
+    # Binario alternativo, p. ej. el motor simulado de bench/
+    override = os.environ.get('ACESTREAM_BINARY')
+    if override:
+        return override
     try:
         # Buscar binarios
         result = subprocess.run(['find', '/opt/acestream', '-name', 'acestreamengine', '-type', 'f'], 
@@ -52,55 +173,372 @@ def find_acestream_binary():
     
     return None
 
-def is_acestream_working():
-    """Verificar si AceStream está funcionando correctamente"""
+def parse_missing_modules(output):
+    """Extraer los módulos Python que faltan de la salida del binario"""
+    missing_modules = []
+    for line in output.split('\n'):
+        if "No module named" in line:
+            # Extraer el nombre del módulo
+            if "'" in line:
+                module_name = line.split("'")[1]
+            elif '"' in line:
+                module_name = line.split('"')[1]
+            else:
+                module_name = line.split()[-1]
+            missing_modules.append(module_name)
+    return missing_modules
+
+def build_engine_inventory():
+    """Construir el inventario del motor: binario, permisos, librerías y módulos"""
+    acestream_binary = locate_acestream_binary()
+    inventory = {
+        "binary_path": acestream_binary,
+        "binary_exists": bool(acestream_binary) and os.path.exists(acestream_binary),
+        "built_at": time.time(),
+        "available": False,
+        "status": "Binary not found"
+    }
+    if not inventory["binary_exists"]:
+        return inventory
+    
     try:
-        acestream_binary = find_acestream_binary()
-        if not acestream_binary or not os.path.exists(acestream_binary):
-            return False, "Binary not found"
-        
-        # Verificar que es ejecutable
-        import stat
         file_stat = os.stat(acestream_binary)
-        is_executable = bool(file_stat.st_mode & stat.S_IEXEC)
+        inventory.update({
+            "file_size": file_stat.st_size,
+            "is_executable": bool(file_stat.st_mode & stat.S_IEXEC),
+            "permissions": oct(file_stat.st_mode)[-3:],
+            "mtime_ns": file_stat.st_mtime_ns,
+            "inode": file_stat.st_ino
+        })
         
-        if not is_executable:
-            return False, "Binary not executable"
+        # Dependencias del sistema
+        try:
+            ldd_result = subprocess.run(['ldd', acestream_binary], capture_output=True, text=True, timeout=10)
+            inventory["ldd_output"] = ldd_result.stdout
+            inventory["dependencies_ok"] = "not found" not in ldd_result.stdout
+            inventory["missing_deps"] = [line for line in ldd_result.stdout.split('\n') if 'not found' in line]
+        except Exception as e:
+            inventory["ldd_error"] = str(e)
+            inventory["dependencies_ok"] = False
+            inventory["missing_deps"] = []
         
-        # Verificar dependencias del sistema
-        ldd_result = subprocess.run(['ldd', acestream_binary], capture_output=True, text=True, timeout=10)
-        if "not found" in ldd_result.stdout:
-            return False, "Missing system dependencies"
+        # Tipo de archivo
+        try:
+            file_result = subprocess.run(['file', acestream_binary], capture_output=True, text=True, timeout=5)
+            inventory["file_type"] = file_result.stdout
+        except Exception as e:
+            inventory["file_type_error"] = str(e)
         
-        # Verificar módulos Python requeridos
+        # Módulos Python requeridos
         try:
             result = subprocess.run([acestream_binary, '--help'], capture_output=True, text=True, timeout=15)
-            if "Missing required module" in result.stdout or "Missing required module" in result.stderr:
-                missing_modules = []
-                output = result.stdout + result.stderr
-                for line in output.split('\n'):
-                    if "No module named" in line:
-                        # Extraer el nombre del módulo
-                        if "'" in line:
-                            module_name = line.split("'")[1]
-                        elif '"' in line:
-                            module_name = line.split('"')[1]
-                        else:
-                            module_name = line.split()[-1]
-                        missing_modules.append(module_name)
-                
-                if missing_modules:
-                    return False, f"Missing Python modules: {', '.join(set(missing_modules))}"
+            inventory["help_works"] = True
+            inventory["help_output"] = result.stdout[:200] + "..." if len(result.stdout) > 200 else result.stdout
+            inventory["missing_modules"] = sorted(set(parse_missing_modules(result.stdout + result.stderr)))
+            help_error = None
         except subprocess.TimeoutExpired:
-            return False, "AceStream binary timeout"
+            inventory["help_works"] = False
+            inventory["help_output"] = "No disponible"
+            inventory["missing_modules"] = []
+            help_error = "AceStream binary timeout"
         except Exception as e:
-            return False, f"Error testing binary: {str(e)}"
-        
-        return True, "OK"
+            inventory["help_works"] = False
+            inventory["help_output"] = "No disponible"
+            inventory["missing_modules"] = []
+            help_error = f"Error testing binary: {str(e)}"
         
+        if not inventory["is_executable"]:
+            inventory["status"] = "Binary not executable"
+        elif not inventory["dependencies_ok"]:
+            inventory["status"] = "Missing system dependencies"
+        elif help_error:
+            inventory["status"] = help_error
+        elif inventory["missing_modules"]:
+            inventory["status"] = f"Missing Python modules: {', '.join(inventory['missing_modules'])}"
+        else:
+            inventory["available"] = True
+            inventory["status"] = "OK"
     except Exception as e:
-        logger.error(f"Error verificando AceStream: {str(e)}")
-        return False, f"Error: {str(e)}"
+        logger.error(f"Error construyendo inventario: {str(e)}")
+        inventory["status"] = f"Error: {str(e)}"
+    
+    logger.info(f"Inventario AceStream: {inventory['binary_path']} ({inventory['status']})")
+    return inventory
+
+def inventory_is_stale(inventory):
+    """El inventario caduca solo si el binario ha cambiado o desaparecido"""
+    if not inventory:
+        return True
+    if not inventory["binary_exists"]:
+        return False
+    try:
+        file_stat = os.stat(inventory["binary_path"])
+    except OSError:
+        return True
+    return (file_stat.st_mtime_ns, file_stat.st_ino) != (inventory.get("mtime_ns"), inventory.get("inode"))
+
+def get_engine_inventory(refresh=False, blocking=True):
+    """Devolver el inventario en caché, reconstruyéndolo si hace falta.
+
+    Con blocking=False no se espera a una reconstrucción en curso: se devuelve
+    el último inventario conocido (o uno provisional si aún no hay ninguno).
+    """
+    global engine_inventory
+    if not inventory_lock.acquire(blocking):
+        return engine_inventory or {"binary_path": None, "binary_exists": False, "built_at": None,
+                                    "available": False, "status": "Building inventory"}
+    try:
+        if refresh or inventory_is_stale(engine_inventory):
+            engine_inventory = build_engine_inventory()
+        return engine_inventory
+    finally:
+        inventory_lock.release()
+
+def find_acestream_binary():
+    """Devolver el path del binario principal de AceStream"""
+    return get_engine_inventory()["binary_path"]
+
+def is_acestream_working(blocking=True):
+    """Verificar si AceStream está funcionando correctamente"""
+    inventory = get_engine_inventory(blocking=blocking)
+    return inventory["available"], inventory["status"]
+
+def run_execution_tests(acestream_binary):
+    """Ejecutar el binario con diferentes argumentos para diagnóstico"""
+    test_commands = [
+        ['--help'],
+        ['--version'],
+        ['-h'],
+        []
+    ]
+    
+    execution_tests = {}
+    for cmd_args in test_commands:
+        try:
+            result = subprocess.run([acestream_binary] + cmd_args, 
+                                  capture_output=True, text=True, timeout=5)
+            execution_tests[str(cmd_args)] = {
+                "return_code": result.returncode,
+                "stdout": result.stdout[:500],
+                "stderr": result.stderr[:500]
+            }
+        except subprocess.TimeoutExpired:
+            execution_tests[str(cmd_args)] = {"error": "timeout"}
+        except Exception as e:
+            execution_tests[str(cmd_args)] = {"error": str(e)}
+    return execution_tests
+
+# Detección de arranque del motor: en lugar de esperar un tiempo fijo se sondea
+# el puerto HTTP, el estado del proceso y (opcionalmente) el log del motor
+ENGINE_READY_TIMEOUT = float(os.environ.get('ACESTREAM_READY_TIMEOUT', 30))
+ENGINE_READY_POLL = float(os.environ.get('ACESTREAM_READY_POLL', 0.25))
+ENGINE_READY_MARKERS = [m for m in os.environ.get('ACESTREAM_READY_MARKERS', '').split('|') if m]
+DAEMON_LOG_FILE = '/tmp/acestream.log'
+
+# Tiempos de arranque medidos (los más recientes) para ver su distribución
+startup_times = collections.deque(maxlen=1000)
+
+def engine_api_ready(port):
+    """Comprobar si la API HTTP del motor responde en el puerto indicado"""
+    try:
+        response = requests.get(f"http://127.0.0.1:{port}/webui/api/service",
+                                params={"method": "get_version", "format": "json"}, timeout=1)
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+def log_has_ready_marker(log_file, offset):
+    """Leer el log del motor desde offset y buscar marcas de arranque"""
+    try:
+        with open(log_file, 'r', errors='replace') as f:
+            f.seek(offset)
+            chunk = f.read()
+            return any(marker in chunk for marker in ENGINE_READY_MARKERS), f.tell()
+    except OSError:
+        return False, offset
+
+def log_offset(log_file):
+    """Posición actual del log, para leer solo lo que escriba el nuevo proceso"""
+    try:
+        return os.path.getsize(log_file)
+    except OSError:
+        return 0
+
+def wait_for_engine_ready(process, port=6878, timeout=None, log_file=None, offset=0):
+    """Esperar a que el motor esté listo.
+
+    Devuelve (ready, reason, elapsed): ready es True en cuanto la API HTTP
+    responde o aparece una marca de arranque en el log; False si el proceso
+    termina o se agota el plazo. log_file puede ser una ruta o una lista de
+    rutas (stdout y stderr de un motor del pool), todas leídas desde offset.
+    """
+    timeout = ENGINE_READY_TIMEOUT if timeout is None else timeout
+    log_files = [log_file] if isinstance(log_file, str) else list(log_file or ())
+    offsets = dict.fromkeys(log_files, offset)
+    started = time.monotonic()
+    deadline = started + timeout
+    while True:
+        elapsed = time.monotonic() - started
+        if process.poll() is not None:
+            return False, f"exited with code {process.returncode}", elapsed
+        if ENGINE_READY_MARKERS:
+            for path in log_files:
+                found, offsets[path] = log_has_ready_marker(path, offsets[path])
+                if found:
+                    return True, "log marker", elapsed
+        if engine_api_ready(port):
+            return True, "http api", time.monotonic() - started
+        if time.monotonic() >= deadline:
+            return False, "timeout", time.monotonic() - started
+        time.sleep(ENGINE_READY_POLL)
+
+def record_startup_time(stream_id, seconds, ready, kind="engine", profile=DEFAULT_PROFILE):
+    """Guardar el tiempo de arranque medido de un stream"""
+    if ready:
+        STREAM_TIME_TO_READY.observe(seconds, kind=kind, profile=profile)
+    startup_times.append({
+        "stream_id": stream_id,
+        "seconds": round(seconds, 3),
+        "ready": ready,
+        "profile": profile,
+        "timestamp": time.time()
+    })
+
+def percentile(values, pct):
+    """Percentil por el método del rango más cercano"""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(pct / 100.0 * len(values))) - 1))
+    return values[index]
+
+# Bombeo de logs: stdout/stderr de cada motor van a ficheros por stream en
+# ENGINE_LOG_DIR (un pipe moriría con esta API y el motor readoptado recibiría
+# EPIPE al escribir). Un hilo por fichero los sigue y los vuelca en un buffer
+# circular acotado; si un fichero pasa de ENGINE_LOG_MAX_BYTES se trunca una
+# vez leído (el motor escribe en modo append y sigue desde el principio).
+ENGINE_LOG_LINES = int(os.environ.get('ENGINE_LOG_LINES', 2000))
+ENGINE_LOG_KEEP = int(os.environ.get('ENGINE_LOG_KEEP', 50))
+ENGINE_LOG_DIR = os.environ.get('ENGINE_LOG_DIR', '/tmp/acestream_logs')
+ENGINE_LOG_MAX_BYTES = int(os.environ.get('ENGINE_LOG_MAX_BYTES', 10 * 1024 * 1024))
+ENGINE_LOG_POLL = 0.2
+# Al readoptar un motor se muestra el final de lo que ya había escrito
+ENGINE_LOG_ADOPT_TAIL = 64 * 1024
+
+engine_logs = collections.OrderedDict()
+engine_logs_lock = threading.Lock()
+
+def engine_log_paths(key):
+    safe = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+    return {name: os.path.join(ENGINE_LOG_DIR, f"{safe}.{name}.log") for name in ("stdout", "stderr")}
+
+def engine_output(key):
+    """Descriptores (vacíos, en modo append) para stdout y stderr de un motor nuevo"""
+    os.makedirs(ENGINE_LOG_DIR, exist_ok=True)
+    return {name: os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+            for name, path in engine_log_paths(key).items()}
+
+def spawn_engine(key, cmd):
+    """Lanzar un motor en su propia sesión con la salida en ficheros y empezar a seguirla"""
+    output = engine_output(key)
+    try:
+        process = subprocess.Popen(cmd, stdout=output["stdout"], stderr=output["stderr"],
+                                   stdin=subprocess.DEVNULL, preexec_fn=os.setsid)
+    finally:
+        for fd in output.values():
+            os.close(fd)
+    start_log_pump(key, process)
+    return process
+
+def follow_log(buffer, path, name, position):
+    """Seguir un fichero de salida hasta que el proceso termine y no quede nada por leer"""
+    pending = b""
+    while True:
+        exited = buffer["exited"].is_set()
+        data = b""
+        try:
+            size = os.path.getsize(path)
+            if size < position:
+                # Truncado (por nosotros o por un motor nuevo con la misma clave)
+                position = 0
+            with open(path, 'rb') as f:
+                f.seek(position)
+                data = f.read()
+                position = f.tell()
+            if position > ENGINE_LOG_MAX_BYTES:
+                os.truncate(path, 0)
+                position = 0
+        except OSError:
+            pass
+        pending += data
+        *lines, pending = pending.split(b"\n")
+        if lines:
+            with buffer["cond"]:
+                for line in lines:
+                    buffer["seq"] += 1
+                    buffer["lines"].append((buffer["seq"], time.time(), name,
+                                            line.decode('utf8', 'replace').rstrip('\r')))
+                buffer["cond"].notify_all()
+        if not data:
+            if exited:
+                break
+            buffer["exited"].wait(ENGINE_LOG_POLL)
+
+def reap_process(buffer, process, followers):
+    """Esperar al proceso (sin zombies) y a que se lea el resto de su salida"""
+    returncode = process.wait()
+    buffer["exited"].set()
+    for follower in followers:
+        follower.join()
+    with buffer["cond"]:
+        buffer["returncode"] = returncode
+        buffer["exited_at"] = time.time()
+        buffer["cond"].notify_all()
+    logger.debug(f"Proceso {process.pid} recogido (código {returncode})")
+
+def start_log_pump(key, process, tail_bytes=0):
+    """Empezar a seguir la salida del proceso en el buffer de key.
+
+    tail_bytes > 0 (motor readoptado) empieza por el final de lo ya escrito.
+    """
+    buffer = {
+        "pid": process.pid,
+        "lines": collections.deque(maxlen=ENGINE_LOG_LINES),
+        "seq": 0,
+        "returncode": None,
+        "started_at": time.time(),
+        "exited_at": None,
+        "exited": threading.Event(),
+        "cond": threading.Condition()
+    }
+    followers = []
+    for name, path in engine_log_paths(key).items():
+        try:
+            position = max(0, os.path.getsize(path) - tail_bytes) if tail_bytes else 0
+        except OSError:
+            position = 0
+        followers.append(threading.Thread(target=follow_log, args=(buffer, path, name, position), daemon=True))
+    for follower in followers:
+        follower.start()
+    buffer["reaper"] = threading.Thread(target=reap_process, args=(buffer, process, followers), daemon=True)
+    buffer["reaper"].start()
+    with engine_logs_lock:
+        engine_logs.pop(key, None)
+        engine_logs[key] = buffer
+        while len(engine_logs) > ENGINE_LOG_KEEP:
+            engine_logs.popitem(last=False)
+    return buffer
+
+def engine_log_tail(key, lines=50, wait=0):
+    """Últimas líneas del log de key; wait espera a que se vacíen los pipes"""
+    buffer = engine_logs.get(key)
+    if buffer is None:
+        return []
+    if wait:
+        buffer["reaper"].join(wait)
+    with buffer["cond"]:
+        tail = list(buffer["lines"])[-lines:] if lines else list(buffer["lines"])
+    return [f"[{name}] {line}" for _, _, name, line in tail]
 
 def start_acestream_daemon():
     """Iniciar el daemon de AceStream en background"""
@@ -109,44 +547,241 @@ def start_acestream_daemon():
         if not acestream_binary:
             raise Exception("AceStream binary not found")
         
-        # Comando para iniciar el daemon
-        cmd = [
-            acestream_binary,
+        # Comando para iniciar el daemon (el perfil puede cambiar el nivel de log)
+        cmd = [acestream_binary] + profile_flags(DAEMON_PROFILE, [
             "--client-console",
-            "--port=6878",
+            f"--port={DAEMON_PORT}",
             "--bind-all",
-            "--log-file=/tmp/acestream.log",
+            f"--log-file={DAEMON_LOG_FILE}",
             "--log-level=debug"
-        ]
+        ])
         
         logger.info(f"Iniciando daemon AceStream: {' '.join(cmd)}")
+        offset = log_offset(DAEMON_LOG_FILE)
         
         # Iniciar el proceso
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            preexec_fn=os.setsid
-        )
+        process = spawn_engine("daemon", cmd)
         
-        # Dar tiempo al daemon para iniciar
-        time.sleep(10)
+        ENGINE_SPAWNS.inc(mode="daemon", profile=DAEMON_PROFILE)
         
+        # Esperar a que el daemon responda (o falle)
+        ready, reason, elapsed = wait_for_engine_ready(process, DAEMON_PORT,
+                                                       log_file=DAEMON_LOG_FILE, offset=offset)
+        record_startup_time("daemon", elapsed, ready, kind="daemon", profile=DAEMON_PROFILE)
+        if process.poll() is not None:
+            output = engine_log_tail("daemon", wait=2)
+            logger.error(f"Daemon AceStream terminó inesperadamente ({reason})")
+            logger.error("salida: " + "\n".join(output))
+            return None
+        
+        if ready:
+            logger.info(f"Daemon AceStream listo en {elapsed:.2f}s ({reason})")
+        else:
+            logger.warning(f"Daemon AceStream sin respuesta tras {elapsed:.2f}s")
         return process
         
     except Exception as e:
         logger.error(f"Error iniciando daemon AceStream: {str(e)}")
         return None
 
-def check_acestream_port():
+# Estado del daemon supervisado (modo "daemon")
+daemon_state = {"process": None, "restarts": 0, "started_at": None}
+daemon_lock = threading.Lock()
+
+def daemon_alive():
+    process = daemon_state["process"]
+    return process is not None and process.poll() is None
+
+def ensure_daemon():
+    """Devolver el proceso del daemon, arrancándolo si no está vivo"""
+    with daemon_lock:
+        if daemon_alive():
+            return daemon_state["process"]
+        if daemon_state["process"] is not None:
+            logger.warning(f"Daemon AceStream caído (código {daemon_state['process'].returncode}), reiniciando")
+            daemon_state["restarts"] += 1
+        process = start_acestream_daemon()
+        daemon_state.update({"process": process, "started_at": time.time() if process else None})
+        return process
+
+def supervise_daemon():
+    """Hilo supervisor: mantener el daemon siempre en marcha"""
+    while True:
+        try:
+            ensure_daemon()
+        except Exception as e:
+            logger.error(f"Error supervisando daemon: {str(e)}")
+        time.sleep(DAEMON_CHECK_INTERVAL)
+
+def open_engine_session(port, stream_id, key="id"):
+    """Abrir una sesión de stream en la API HTTP del motor (key: "id" o "infohash")"""
+    response = requests.get(f"http://127.0.0.1:{port}/ace/getstream",
+                            params={key: stream_id, "format": "json"}, timeout=ENGINE_READY_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
+    if data.get("error"):
+        raise Exception(f"Error del motor: {data['error']}")
+    return data["response"]
+
+def close_engine_session(entry):
+    """Cerrar la sesión de un stream a través de su command_url"""
+    command_url = entry.get("command_url")
+    if not command_url:
+        return
+    try:
+        requests.get(command_url, params={"method": "stop"}, timeout=5)
+        logger.info(f"Sesión cerrada: {entry['stream_id']}")
+    except requests.RequestException as e:
+        logger.warning(f"No se pudo cerrar la sesión {entry['stream_id']}: {str(e)}")
+
+def check_acestream_port(port=6878):
     """Verificar si el puerto 6878 está disponible"""
+    return port_in_use(port)
+
+def port_in_use(port):
+    """Comprobar si hay algo escuchando en el puerto (conexión en proceso)"""
     try:
-        result = subprocess.run(['netstat', '-tuln'], capture_output=True, text=True)
-        return ":6878 " in result.stdout
-    except:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+            return True
+    except OSError:
         return False
 
+def stream_info(entry):
+    """Vista pública (serializable) de una entrada del registro"""
+    return {key: value for key, value in entry.items() if key != "process"}
+
+def stream_response(entry, reused=False):
+    """Respuesta de /start_stream para una entrada del registro"""
+    response = {
+        "status": "started" if entry["state"] == STATE_READY else entry["state"],
+        "stream_id": entry["stream_id"],
+        "stream_url": entry.get("stream_url"),
+        "local_url": entry.get("stream_url"),
+        "pid": entry.get("pid"),
+        "port": entry.get("port"),
+        "method": "acestream-daemon" if entry.get("mode") == "daemon" else "acestream-engine",
+        "ready": entry.get("ready", False),
+        "time_to_ready": entry.get("time_to_ready"),
+        "profile": entry.get("profile", DEFAULT_PROFILE),
+        "relay_url": f"/relay/{entry['stream_id']}"
+    }
+    if entry.get("mode") == "daemon":
+        response["refcount"] = entry.get("refcount", 0)
+    if entry.get("failovers"):
+        response["failovers"] = entry["failovers"]
+        response["infohash"] = entry.get("infohash")
+    if reused:
+        response["reused"] = True
+    return response
+
+def touch_stream(stream_id):
+    """Marcar un stream como usado recientemente (orden LRU)"""
+    with streams_lock:
+        entry = active_streams.get(stream_id)
+        if entry:
+            entry["last_access"] = time.time()
+            active_streams.move_to_end(stream_id)
+
+def refresh_stream_state(entry):
+    """Pasar a failed las entradas cuyo proceso ha terminado"""
+    if entry.get("mode") == "daemon":
+        if entry["state"] == STATE_READY and not daemon_alive():
+            entry.update({"state": STATE_FAILED, "error": "daemon not running", "failed_at": time.time(),
+                          "port": None, "refcount": 0})
+        return
+    process = entry.get("process")
+    if entry["state"] == STATE_READY and process is not None and process.poll() is not None:
+        logger.warning(f"El motor del stream {entry['stream_id']} ha terminado ({process.returncode})")
+        entry.update({"state": STATE_FAILED, "error": f"exited with code {process.returncode}",
+                      "failed_at": time.time(), "port": None, "process": None})
+
+def reserve_stream(stream_id, evicted):
+    """Crear la entrada de un stream con un puerto libre del pool.
+
+    Las entradas expulsadas por LRU salen del registro y se añaden a evicted:
+    el llamante debe terminarlas fuera del lock, también si esto lanza.
+    """
+    now = time.time()
+    with streams_lock:
+        for sid, entry in list(active_streams.items()):
+            refresh_stream_state(entry)
+            if entry["state"] == STATE_FAILED and now - entry.get("failed_at", now) > FAILED_STREAM_TTL:
+                del active_streams[sid]
+        
+        while True:
+            running = [e for e in active_streams.values() if e.get("port") is not None]
+            used_ports = {e["port"] for e in running}
+            free_ports = [p for p in ENGINE_PORTS if p not in used_ports]
+            # El puerto de un expulsado sigue escuchando hasta que se termine su motor
+            reusable = {e["port"] for e in evicted}
+            if len(running) < POOL_SIZE:
+                port = next((p for p in free_ports if p in reusable or not port_in_use(p)), None)
+                if port is not None:
+                    break
+            # Pool lleno: expulsar el stream listo menos usado
+            victim = next((e for e in active_streams.values() if e["state"] == STATE_READY), None)
+            if victim is None:
+                raise Exception("Pool de motores lleno")
+            logger.info(f"Pool lleno, expulsando stream: {victim['stream_id']}")
+            victim["state"] = STATE_STOPPING
+            del active_streams[victim["stream_id"]]
+            evicted.append(victim)
+        
+        active_streams.pop(stream_id, None)
+        entry = {
+            "stream_id": stream_id,
+            "state": STATE_STARTING,
+            "port": port,
+            "pid": None,
+            "process": None,
+            "started_at": now,
+            "last_access": now
+        }
+        active_streams[stream_id] = entry
+    return entry
+
+def mark_stream_failed(stream_id, error):
+    """Marcar un stream como fallido y liberar su puerto"""
+    with streams_lock:
+        entry = active_streams.get(stream_id)
+        if entry and entry["state"] == STATE_STARTING:
+            entry.update({"state": STATE_FAILED, "error": error, "failed_at": time.time(),
+                          "port": None, "process": None})
+            STREAM_FAILURES.inc(mode=entry.get("mode", "pool"))
+
+def terminate_stream(entry):
+    """Terminar el grupo de procesos del motor de un stream"""
+    if entry.get("mode") == "daemon":
+        # El daemon es compartido: solo se cierra la sesión del stream
+        close_engine_session(entry)
+        return
+    process = entry.get("process")
+    pid = entry.get("pid")
+    if not pid:
+        return
+    try:
+        os.killpg(os.getpgid(pid), signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    if process is not None:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            os.killpg(os.getpgid(pid), signal.SIGKILL)
+            process.wait()
+    logger.info(f"Stream detenido: {entry['stream_id']} (PID: {pid})")
+
+def release_stream(stream_id):
+    """Sacar un stream del registro y detener su motor"""
+    with streams_lock:
+        entry = active_streams.pop(stream_id, None)
+        if entry is None:
+            return None
+        entry["state"] = STATE_STOPPING
+        stream_channels.pop(stream_id, None)
+    terminate_stream(entry)
+    return entry
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({"status": "ok", "service": "acestream-control"})
@@ -160,29 +795,259 @@ def start_stream_frontend():
         if not stream_id:
             return jsonify({"error": "stream_id required"}), 400
         
+        remember_channel(stream_id, request.form.get('channel'))
+        
         # Llamar al endpoint interno
-        response = start_stream_internal(stream_id)
-        return response
+        record = log_request('/start', stream_id=stream_id)
+        return start_stream_traced('/start', record["request_id"], stream_id)
         
     except Exception as e:
         logger.error(f"Error en frontend: {str(e)}")
         return jsonify({"error": f"Error starting stream: {str(e)}"}), 500
 
-def start_stream_internal(stream_id):
+# Control de admisión: antes de lanzar un motor se comprueban memoria libre,
+# carga de CPU y motores en marcha. Los arranques que no caben esperan en una
+# cola por prioridad (canales fijados primero, precalentados al final) y si la
+# cola está llena se responde 503 con Retry-After
+ADMISSION_MIN_FREE_MB = float(os.environ.get('ADMISSION_MIN_FREE_MB', 256))
+ADMISSION_MAX_LOAD = float(os.environ.get('ADMISSION_MAX_LOAD', 1.5))
+ADMISSION_MAX_ENGINES = int(os.environ.get('ADMISSION_MAX_ENGINES', len(ENGINE_PORTS)))
+ADMISSION_MAX_STARTING = int(os.environ.get('ADMISSION_MAX_STARTING', 2))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 32))
+ADMISSION_WAIT = float(os.environ.get('ADMISSION_WAIT', 30))
+ADMISSION_POLL = 0.5
+PINNED_STREAMS = {s.strip() for s in os.environ.get('PINNED_STREAMS', '').split(',') if s.strip()}
+PRIORITY_PINNED, PRIORITY_NORMAL, PRIORITY_PREWARM = 0, 1, 2
+
+ADMISSION_REJECTIONS = metrics.Counter('acestream_admission_rejections_total',
+                                       'Engine spawns rejected by admission control, by reason.', ('reason',))
+ADMISSION_QUEUE = metrics.Gauge('acestream_admission_queue_length', 'Engine spawns waiting for admission.')
+
+admission_queue = []
+admission_bumped = set()
+admission_state = {"starting": 0, "seq": 0}
+admission_cond = threading.Condition()
+
+class AdmissionRejected(Exception):
+    """Arranque rechazado por falta de recursos o cola llena"""
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+def stream_priority(stream_id, priority=None):
+    if stream_id in PINNED_STREAMS:
+        return PRIORITY_PINNED
+    return PRIORITY_NORMAL if priority is None else priority
+
+def running_engines():
+    return len(tracked_pids())
+
+def admission_blocker():
+    """Motivo por el que ahora no cabe otro motor, o None si cabe"""
+    free_mb = psutil.virtual_memory().available / 1048576
+    if free_mb < ADMISSION_MIN_FREE_MB:
+        return "memory"
+    if os.getloadavg()[0] / (psutil.cpu_count() or 1) > ADMISSION_MAX_LOAD:
+        return "load"
+    if running_engines() >= ADMISSION_MAX_ENGINES:
+        with streams_lock:
+            # Con un stream listo expulsable el nuevo motor sustituye a otro
+            if not any(e["state"] == STATE_READY and e.get("mode") != "daemon" for e in active_streams.values()):
+                return "engines"
+    return None
+
+def admission_retry_after(position):
+    """Segundos estimados hasta que haya hueco para la posición dada de la cola"""
+    ready_times = [s["seconds"] for s in startup_times if s["ready"]]
+    per_start = percentile(ready_times, 50) if ready_times else ENGINE_READY_TIMEOUT / 2
+    return max(1, int(per_start * (position + 1) / max(1, ADMISSION_MAX_STARTING) + 0.999))
+
+def admit_spawn(stream_id, priority):
+    """Esperar turno para lanzar un motor; lanza AdmissionRejected si no lo hay"""
+    with admission_cond:
+        admission_state["seq"] += 1
+        ticket = (priority, admission_state["seq"], stream_id)
+        if len(admission_queue) >= ADMISSION_QUEUE_SIZE:
+            # Cola llena: un arranque más prioritario desplaza al último de la cola
+            worst = max(admission_queue) if admission_queue else None
+            if worst is None or worst[0] <= priority:
+                ADMISSION_REJECTIONS.inc(reason="queue_full")
+                raise AdmissionRejected("admission queue full", admission_retry_after(len(admission_queue)))
+            admission_queue.remove(worst)
+            heapq.heapify(admission_queue)
+            admission_bumped.add(worst)
+        heapq.heappush(admission_queue, ticket)
+        ADMISSION_QUEUE.set(len(admission_queue))
+        deadline = time.time() + ADMISSION_WAIT
+        blocker = None
+        try:
+            while True:
+                if ticket in admission_bumped:
+                    admission_bumped.discard(ticket)
+                    ADMISSION_REJECTIONS.inc(reason="queue_full")
+                    raise AdmissionRejected("admission queue full", admission_retry_after(len(admission_queue)))
+                if admission_queue[0] == ticket and admission_state["starting"] < ADMISSION_MAX_STARTING:
+                    blocker = admission_blocker()
+                    if blocker is None:
+                        heapq.heappop(admission_queue)
+                        admission_state["starting"] += 1
+                        return
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                # Los recursos cambian sin aviso: volver a mirar cada poco
+                admission_cond.wait(min(remaining, ADMISSION_POLL))
+            admission_queue.remove(ticket)
+            heapq.heapify(admission_queue)
+            reason = blocker or "busy"
+            ADMISSION_REJECTIONS.inc(reason=reason)
+            logger.warning(f"Arranque de {stream_id} rechazado por admisión ({reason})")
+            raise AdmissionRejected(f"insufficient resources ({reason})",
+                                    admission_retry_after(len(admission_queue)))
+        except Exception:
+            # Si falla la medida de recursos el turno no puede quedarse bloqueando la cola
+            if ticket in admission_queue:
+                admission_queue.remove(ticket)
+                heapq.heapify(admission_queue)
+            raise
+        finally:
+            ADMISSION_QUEUE.set(len(admission_queue))
+            admission_cond.notify_all()
+
+def release_spawn():
+    with admission_cond:
+        admission_state["starting"] -= 1
+        admission_cond.notify_all()
+
+# Arranques en curso por stream_id: las peticiones concurrentes para el mismo
+# stream esperan al arranque de la primera en lugar de lanzar otro motor
+start_flights = {}
+
+def start_stream_traced(route, request_id, stream_id, profile=None):
+    """start_stream_internal con traza de fases; la respuesta lleva X-Request-Id"""
+    trace = tracing.start(route, request_id=request_id, stream_id=stream_id, profile=profile)
+    status_code = 500
+    try:
+        response, status_code = start_stream_internal(stream_id, profile)
+    finally:
+        if trace:
+            trace.finish(status=status_code)
+    response.headers["X-Request-Id"] = request_id
+    return response, status_code
+
+def start_stream_internal(stream_id, profile=None):
     """Lógica interna para iniciar stream"""
-    # Limpiar streams anteriores
-    stop_all_streams()
+    payload, status_code = launch_stream(stream_id, profile=profile)
+    response = jsonify(payload)
+    if payload.get("retry_after"):
+        response.headers["Retry-After"] = str(payload["retry_after"])
+    return response, status_code
+
+def reuse_stream(entry):
+    """Respuesta para un stream ya listo (en modo daemon suma una referencia)"""
+    if entry.get("mode") == "daemon" and not entry.get("prewarmed"):
+        entry["refcount"] += 1
+    # La referencia del precalentamiento pasa al primer espectador
+    entry["prewarmed"] = False
+    touch_stream(entry["stream_id"])
+    logger.debug(f"Stream ya activo: {entry['stream_id']}")
+    return stream_response(entry, reused=True)
+
+def no_progress(state, **detail):
+    pass
+
+def launch_stream(stream_id, progress=no_progress, priority=None, profile=None, prewarm=False):
+    """Iniciar un stream con semántica single-flight.
+
+    Devuelve (payload, status_code). La primera petición hace el trabajo; las
+    concurrentes para el mismo stream_id esperan y reciben el mismo resultado,
+    y las que llegan con el stream ya listo salen directamente del registro.
+    progress(state, **detail) recibe las fases intermedias del arranque y
+    priority ordena la cola de admisión (los canales fijados van primero) y
+    profile elige el perfil de ajuste del motor; un stream ya en marcha se
+    reutiliza con el perfil con el que arrancó. Con prewarm el stream solo
+    queda marcado como precalentado si esta llamada es la que lo arranca.
+    """
+    with streams_lock:
+        entry = active_streams.get(stream_id)
+        if entry:
+            refresh_stream_state(entry)
+            if entry["state"] == STATE_READY:
+                tracing.mark("reused", stream_id=stream_id)
+                return reuse_stream(entry), 200
+        flight = start_flights.get(stream_id)
+        leader = flight is None
+        if leader:
+            flight = start_flights[stream_id] = {"event": threading.Event(), "result": None}
+    
+    if not leader:
+        logger.debug(f"Esperando arranque en curso: {stream_id}")
+        progress("connecting", coalesced=True)
+        with tracing.span("coalesced_wait"):
+            finished = flight["event"].wait(ENGINE_READY_TIMEOUT + 30)
+        if not finished:
+            return {"status": STATE_STARTING, "stream_id": stream_id}, 202
+        with streams_lock:
+            entry = active_streams.get(stream_id)
+            if entry and entry["state"] == STATE_READY:
+                return dict(reuse_stream(entry), coalesced=True), 200
+        payload, status_code = flight["result"]
+        return dict(payload, coalesced=True), status_code
     
+    result = ({"error": "Error starting stream"}, 500)
+    try:
+        if ENGINE_MODE == 'daemon':
+            result = start_stream_daemon(stream_id, progress)
+        else:
+            try:
+                with tracing.span("admission", priority=stream_priority(stream_id, priority)):
+                    admit_spawn(stream_id, stream_priority(stream_id, priority))
+            except AdmissionRejected as e:
+                result = ({"error": str(e), "stream_id": stream_id, "retry_after": e.retry_after}, 503)
+            else:
+                try:
+                    result = start_stream_engine(stream_id, progress, profile or DEFAULT_PROFILE)
+                finally:
+                    release_spawn()
+        if prewarm:
+            # Antes de despertar a los que esperan: el primero que se sume recibe la referencia
+            with streams_lock:
+                entry = active_streams.get(stream_id)
+                if entry and entry["state"] == STATE_READY:
+                    entry["prewarmed"] = True
+    finally:
+        with streams_lock:
+            flight["result"] = result
+            start_flights.pop(stream_id, None)
+        flight["event"].set()
+    return result
+
+def start_stream_engine(stream_id, progress=no_progress, profile=DEFAULT_PROFILE):
+    """Lanzar un motor dedicado del pool para el stream"""
     try:
         logger.debug(f"Iniciando stream con ID: {stream_id}")
         
         # Verificar que AceStream está funcionando
-        acestream_ok, acestream_status = is_acestream_working()
+        with tracing.span("health_check"):
+            acestream_ok, acestream_status = is_acestream_working()
         if not acestream_ok:
             raise Exception(f"AceStream no está disponible: {acestream_status}")
         
         # Método 1: Intentar con el daemon
-        acestream_binary = find_acestream_binary()
+        with tracing.span("binary_lookup"):
+            acestream_binary = find_acestream_binary()
+        
+        # Reservar un puerto del pool (expulsando el stream menos usado si está lleno)
+        evicted = []
+        try:
+            with tracing.span("reserve_port"):
+                entry = reserve_stream(stream_id, evicted)
+        finally:
+            with tracing.span("evict", streams=[old_entry["stream_id"] for old_entry in evicted]):
+                for old_entry in evicted:
+                    terminate_stream(old_entry)
+        port = entry["port"]
         
         # Comando simplificado para stream específico
         cmd = [
@@ -190,52 +1055,129 @@ def start_stream_internal(stream_id):
             "--client-console",
             "--startup-connect",
             f"--stream-id={stream_id}",
-            "--port=6878",
+            f"--port={port}",
             "--bind-all"
-        ]
+        ] + profile_flags(profile)
         
         logger.info(f"Ejecutando comando: {' '.join(cmd)}")
         
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            preexec_fn=os.setsid
-        )
+        with tracing.span("spawn", port=port, profile=profile):
+            process = spawn_engine(stream_id, cmd)
+        ENGINE_SPAWNS.inc(mode="pool", profile=profile)
+        with streams_lock:
+            entry.update({"process": process, "pid": process.pid, "profile": profile})
+        progress("spawned", pid=process.pid, port=port)
+        progress("connecting", port=port)
         
-        # Esperar un poco más para que el stream se establezca
-        time.sleep(20)
+        # Esperar a que el motor esté listo o termine
+        with tracing.span("wait_ready") as span:
+            ready, reason, elapsed = wait_for_engine_ready(process, port,
+                                                           log_file=list(engine_log_paths(stream_id).values()))
+            span.update(ready=ready, reason=reason)
+        record_startup_time(stream_id, elapsed, ready, profile=profile)
         
         # Verificar si el proceso sigue ejecutándose
-        if process.poll() is None:
-            active_streams[stream_id] = process.pid
-            domain = os.environ.get('RAILWAY_PUBLIC_DOMAIN', 'localhost:8080')
-            stream_url = f"http://127.0.0.1:6878/ace/getstream?id={stream_id}"
+        if ready and process.poll() is None:
+            with streams_lock:
+                entry.update({
+                    "state": STATE_READY,
+                    "ready": ready,
+                    "ready_at": time.time(),
+                    "time_to_ready": round(elapsed, 3),
+                    "stream_url": f"http://127.0.0.1:{port}/ace/getstream?id={stream_id}"
+                })
             
-            logger.info(f"Stream iniciado: {stream_id}, URL: {stream_url}")
-            return jsonify({
-                "status": "started",
-                "stream_id": stream_id,
-                "stream_url": stream_url,
-                "local_url": f"http://127.0.0.1:6878/ace/getstream?id={stream_id}",
-                "pid": process.pid,
-                "method": "acestream-engine"
-            })
+            logger.info(f"Stream iniciado: {stream_id}, URL: {entry['stream_url']}")
+            return stream_response(entry), 200
+        if process.poll() is None:
+            # Un motor colgado no ocupa un puesto del pool ni se sirve a los clientes
+            logger.error(f"Stream {stream_id} sin confirmar tras {elapsed:.2f}s, deteniendo el motor")
+            terminate_stream(entry)
         else:
             # Obtener logs del proceso
-            stdout, stderr = process.communicate()
-            logger.error(f"AceStream terminó inesperadamente")
-            logger.error(f"stdout: {stdout}")
-            logger.error(f"stderr: {stderr}")
-            
-            # Intentar método alternativo
-            return start_stream_alternative(stream_id)
+            output = engine_log_tail(stream_id, wait=2)
+            logger.error(f"AceStream terminó inesperadamente tras {elapsed:.2f}s ({reason})")
+            logger.error("salida: " + "\n".join(output))
+        mark_stream_failed(stream_id, reason)
+        
+        # Intentar método alternativo
+        return start_stream_alternative(stream_id)
                 
     except Exception as e:
         logger.error(f"Error en método principal: {str(e)}")
+        mark_stream_failed(stream_id, str(e))
         return start_stream_alternative(stream_id)
 
+def start_stream_daemon(stream_id, progress=no_progress):
+    """Abrir la sesión de un stream en el daemon compartido"""
+    with streams_lock:
+        now = time.time()
+        entry = {
+            "stream_id": stream_id,
+            "mode": "daemon",
+            "state": STATE_STARTING,
+            "port": DAEMON_PORT,
+            "pid": None,
+            # El daemon es compartido: sus sesiones usan el perfil del daemon
+            "profile": DAEMON_PROFILE,
+            "refcount": 0,
+            "started_at": now,
+            "last_access": now
+        }
+        active_streams.pop(stream_id, None)
+        active_streams[stream_id] = entry
+    
+    try:
+        with tracing.span("ensure_daemon"):
+            process = ensure_daemon()
+        if not process:
+            raise Exception("Daemon AceStream no disponible")
+        progress("spawned", pid=process.pid, port=DAEMON_PORT)
+        progress("connecting", port=DAEMON_PORT)
+        
+        started = time.monotonic()
+        with tracing.span("open_session"):
+            session = open_engine_session(DAEMON_PORT, stream_id)
+        elapsed = time.monotonic() - started
+        record_startup_time(stream_id, elapsed, True, kind="session", profile=DAEMON_PROFILE)
+        
+        with streams_lock:
+            entry.update({
+                "state": STATE_READY,
+                "pid": process.pid,
+                "refcount": 1,
+                "ready": True,
+                "ready_at": time.time(),
+                "time_to_ready": round(elapsed, 3),
+                "stream_url": session["playback_url"],
+                "playback_url": session["playback_url"],
+                "stat_url": session.get("stat_url"),
+                "command_url": session.get("command_url"),
+                "infohash": session.get("infohash")
+            })
+        logger.info(f"Sesión abierta en el daemon: {stream_id}, URL: {entry['stream_url']}")
+        return stream_response(entry), 200
+    
+    except Exception as e:
+        logger.error(f"Error abriendo sesión en el daemon: {str(e)}")
+        mark_stream_failed(stream_id, str(e))
+        return start_stream_alternative(stream_id)
+
+def release_stream_reference(stream_id):
+    """Soltar una referencia a un stream; la última cierra la sesión.
+
+    Devuelve el número de referencias restantes.
+    """
+    with streams_lock:
+        entry = active_streams.get(stream_id)
+        if entry is None:
+            return 0
+        if entry.get("mode") == "daemon" and entry.get("refcount", 0) > 1:
+            entry["refcount"] -= 1
+            return entry["refcount"]
+    release_stream(stream_id)
+    return 0
+
 def start_stream_alternative(stream_id):
     """Método alternativo para iniciar stream"""
     try:
@@ -244,15 +1186,18 @@ def start_stream_alternative(stream_id):
         # Verificar si hay un servicio web disponible
         try:
             service_url = "http://localhost:8080/search.m3u"
-            response = requests.get(service_url, timeout=5)
+            with tracing.span("fallback_probe", url=service_url) as span:
+                response = requests.get(service_url, timeout=5)
+                span["status"] = response.status_code
             if response.status_code == 200:
                 logger.info("Servicio web encontrado")
-                return jsonify({
+                STREAM_FALLBACKS.inc(branch="web-service")
+                return {
                     "status": "started",
                     "stream_id": stream_id,
                     "stream_url": f"http://localhost:8080/search.m3u?id={stream_id}",
                     "method": "web-service"
-                })
+                }, 200
         except:
             pass
         
@@ -261,17 +1206,270 @@ def start_stream_alternative(stream_id):
         external_url = f"http://127.0.0.1:6878/ace/getstream?id={stream_id}"
         
         logger.warning(f"Usando fallback: {external_url}")
-        return jsonify({
+        STREAM_FALLBACKS.inc(branch="fallback")
+        return {
             "status": "started",
             "stream_id": stream_id,
             "stream_url": external_url,
             "method": "fallback",
             "message": "Stream configurado - puede necesitar tiempo adicional para inicializar"
-        })
+        }, 200
         
     except Exception as e:
         logger.error(f"Error en método alternativo: {str(e)}")
-        return jsonify({"error": f"Error starting stream: {str(e)}"}), 500
+        STREAM_FALLBACKS.inc(branch="error")
+        return {"error": f"Error starting stream: {str(e)}"}, 500
+
+@metrics.on_collect
+def collect_stream_gauges():
+    counts = dict.fromkeys((STATE_STARTING, STATE_READY, STATE_FAILED, STATE_STOPPING), 0)
+    with streams_lock:
+        for entry in active_streams.values():
+            counts[entry["state"]] = counts.get(entry["state"], 0) + 1
+    for state, count in counts.items():
+        ACTIVE_STREAMS.set(count, state=state)
+    by_profile = dict.fromkeys(ENGINE_PROFILES, 0)
+    with streams_lock:
+        for entry in active_streams.values():
+            if entry["state"] == STATE_READY:
+                profile = entry.get("profile", DEFAULT_PROFILE)
+                by_profile[profile] = by_profile.get(profile, 0) + 1
+    for profile, count in by_profile.items():
+        PROFILE_STREAMS.set(count, profile=profile)
+
+def tracked_pids():
+    """PIDs de motor vivos: los del registro y el del daemon"""
+    pids = {}
+    with streams_lock:
+        for entry in active_streams.values():
+            if entry.get("mode") == "daemon":
+                continue
+            refresh_stream_state(entry)
+            # Las entradas fallidas conservan su pid, pero ya no tienen puerto ni proceso
+            if entry.get("pid") and entry.get("port") is not None:
+                pids[entry["pid"]] = entry["stream_id"]
+    if daemon_alive():
+        pids[daemon_state["process"].pid] = "daemon"
+    return pids
+
+def sample_engine_resources(processes):
+    """Tomar una muestra de CPU, RSS, hilos y descriptores de cada motor"""
+    pids = tracked_pids()
+    for pid in list(processes):
+        if pid not in pids:
+            del processes[pid]
+    for gauge in (ENGINE_CPU, ENGINE_RSS, ENGINE_THREADS, ENGINE_FDS):
+        gauge.clear()
+    for pid, stream_id in pids.items():
+        try:
+            proc = processes.get(pid)
+            if proc is None:
+                # La primera llamada a cpu_percent solo fija la referencia
+                proc = processes[pid] = psutil.Process(pid)
+                proc.cpu_percent(None)
+            with proc.oneshot():
+                labels = {"stream_id": stream_id, "pid": pid}
+                ENGINE_CPU.set(proc.cpu_percent(None), **labels)
+                ENGINE_RSS.set(proc.memory_info().rss, **labels)
+                ENGINE_THREADS.set(proc.num_threads(), **labels)
+                ENGINE_FDS.set(proc.num_fds(), **labels)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            processes.pop(pid, None)
+
+def resource_sampler():
+    """Hilo de muestreo: el scrape de /metrics solo lee los últimos valores"""
+    processes = {}
+    while True:
+        try:
+            sample_engine_resources(processes)
+        except Exception as e:
+            logger.error(f"Error muestreando recursos: {str(e)}")
+        time.sleep(METRICS_SAMPLE_INTERVAL)
+
+# Precalentamiento: arrancar antes de tiempo los streams que el historial de
+# peticiones indica que se van a pedir en la próxima franja horaria
+PREWARM_ENABLED = os.environ.get('ACESTREAM_PREWARM', '0') == '1'
+PREWARM_INTERVAL = float(os.environ.get('PREWARM_INTERVAL', 60))
+PREWARM_WINDOW = int(os.environ.get('PREWARM_WINDOW', 3600))
+PREWARM_LEAD = int(os.environ.get('PREWARM_LEAD', 300))
+PREWARM_TOP_K = int(os.environ.get('PREWARM_TOP_K', 3))
+PREWARM_BUDGET = int(os.environ.get('PREWARM_BUDGET', 2))
+PREWARM_IDLE = float(os.environ.get('PREWARM_IDLE', 900))
+PREWARM_HISTORY_DAYS = int(os.environ.get('PREWARM_HISTORY_DAYS', 14))
+
+# Streams retirados por inactividad: no se vuelven a precalentar en la misma franja
+prewarm_retired = {}
+
+def time_slot(timestamp):
+    """Franja del día (según PREWARM_WINDOW) a la que pertenece un instante"""
+    local = time.localtime(timestamp)
+    seconds = local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+    return seconds // PREWARM_WINDOW
+
+def predict_streams(records, now=None):
+    """Top-K de stream_ids pedidos en la franja que empieza dentro de PREWARM_LEAD"""
+    now = time.time() if now is None else now
+    slot = time_slot(now + PREWARM_LEAD)
+    counts = collections.Counter(
+        record["stream_id"] for record in records
+        if record.get("stream_id") and time_slot(record["timestamp"]) == slot
+    )
+    return [stream_id for stream_id, _ in counts.most_common(PREWARM_TOP_K)]
+
+def prewarm_cycle():
+    """Una pasada del precalentador: retirar los ociosos y arrancar los previstos"""
+    now = time.time()
+    with streams_lock:
+        idle = [sid for sid, entry in active_streams.items()
+                if entry.get("prewarmed") and now - entry.get("last_access", entry["started_at"]) > PREWARM_IDLE]
+    for stream_id in idle:
+        logger.info(f"Precalentado sin espectadores, deteniendo: {stream_id}")
+        release_stream(stream_id)
+        prewarm_retired[stream_id] = now
+    for stream_id, retired_at in list(prewarm_retired.items()):
+        if now - retired_at > PREWARM_WINDOW:
+            del prewarm_retired[stream_id]
+    
+    records = read_requests(since=now - PREWARM_HISTORY_DAYS * 86400)
+    for stream_id in predict_streams(records, now):
+        with streams_lock:
+            warmed = sum(1 for entry in active_streams.values() if entry.get("prewarmed"))
+            running = sum(1 for entry in active_streams.values() if entry.get("port") is not None)
+            # Ni los que ya están en marcha ni los que se están arrancando (o esperan admisión)
+            if stream_id in active_streams or stream_id in start_flights or stream_id in prewarm_retired:
+                continue
+            # Nunca expulsar streams con espectadores para precalentar
+            if warmed >= PREWARM_BUDGET or (ENGINE_MODE == 'pool' and running >= POOL_SIZE):
+                break
+        logger.info(f"Precalentando stream: {stream_id}")
+        launch_stream(stream_id, priority=PRIORITY_PREWARM, prewarm=True)
+
+def prewarm_loop():
+    """Hilo del precalentador"""
+    while True:
+        try:
+            prewarm_cycle()
+        except Exception as e:
+            logger.error(f"Error en precalentamiento: {str(e)}")
+        time.sleep(PREWARM_INTERVAL)
+
+# Arranques asíncronos: /start_stream devuelve un job_id al momento y el
+# progreso se consulta en /jobs/<job_id> o se sigue por SSE. Con async=false
+# (o ACESTREAM_ASYNC_START=0 para todas) la petición espera al arranque
+ASYNC_START = os.environ.get('ACESTREAM_ASYNC_START', '1') == '1'
+MAX_JOBS = 500
+JOB_TERMINAL_STATES = ("ready", "failed")
+
+start_jobs = collections.OrderedDict()
+jobs_cond = threading.Condition()
+start_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(4, POOL_SIZE * 2),
+                                                       thread_name_prefix="start")
+
+def parse_flag(value, default):
+    """Booleano de JSON o de la query string ("1", "true", "no"...); None si no lo es"""
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    text = str(value).strip().lower()
+    if text in ("1", "true", "yes", "on"):
+        return True
+    if text in ("0", "false", "no", "off"):
+        return False
+    return None
+
+def job_event(job, state, **detail):
+    """Añadir una fase al job y despertar a quien la esté esperando"""
+    with jobs_cond:
+        job["state"] = state
+        job["events"].append(dict(detail, state=state, timestamp=time.time()))
+        jobs_cond.notify_all()
+
+def run_start_job(job):
+    """Ejecutar el arranque de un job en un hilo del pool"""
+    trace = job.get("trace")
+    payload, status_code = {"error": "Error starting stream"}, 500
+    with tracing.activate(trace):
+        if trace:
+            trace.emit("queued", job["created_at"], time.time() - job["created_at"])
+        try:
+            payload, status_code = launch_stream(job["stream_id"],
+                                                 lambda state, **detail: job_event(job, state, **detail),
+                                                 profile=job.get("profile"))
+        except Exception as e:
+            logger.error(f"Error en job {job['job_id']}: {str(e)}")
+            payload, status_code = {"error": f"Error starting stream: {str(e)}"}, 500
+        finally:
+            if trace:
+                trace.finish(status=status_code, job_id=job["job_id"])
+    job["result"] = payload
+    job["status_code"] = status_code
+    job_event(job, "ready" if status_code < 400 else "failed", method=payload.get("method"))
+
+def submit_start_job(stream_id, profile=None, request_id=None, route='/start_stream'):
+    """Crear un job de arranque y encolarlo"""
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "request_id": request_id,
+        "trace": tracing.new(route, request_id=request_id, stream_id=stream_id, profile=profile),
+        "stream_id": stream_id,
+        "profile": profile,
+        "state": "queued",
+        "created_at": time.time(),
+        "events": [],
+        "result": None
+    }
+    with jobs_cond:
+        start_jobs[job["job_id"]] = job
+        while len(start_jobs) > MAX_JOBS:
+            start_jobs.popitem(last=False)
+    start_executor.submit(run_start_job, job)
+    return job
+
+def job_response(job):
+    with jobs_cond:
+        return {key: (list(value) if key == "events" else value)
+                for key, value in job.items() if key != "trace"}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Estado de un job de arranque"""
+    job = start_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job_response(job))
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Progreso de un job como Server-Sent Events"""
+    job = start_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    
+    def generate():
+        sent = 0
+        while True:
+            with jobs_cond:
+                if sent >= len(job["events"]) and job["state"] not in JOB_TERMINAL_STATES:
+                    jobs_cond.wait(15)
+                events = job["events"][sent:]
+                finished = job["state"] in JOB_TERMINAL_STATES
+            if not events and not finished:
+                # Comentario SSE para mantener viva la conexión
+                yield ": keep-alive\n\n"
+            for event in events:
+                data = dict(event, job_id=job_id, stream_id=job["stream_id"])
+                if event["state"] in JOB_TERMINAL_STATES:
+                    data["result"] = job["result"]
+                yield f"event: {event['state']}\ndata: {json.dumps(data)}\n\n"
+            sent += len(events)
+            if finished and sent >= len(job["events"]):
+                return
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route('/start_stream', methods=['POST'])
 def start_stream():
@@ -281,20 +1479,42 @@ def start_stream():
     
     if not stream_id:
         return jsonify({"error": "stream_id required"}), 400
+    profile = data.get('profile')
+    if profile is not None and profile not in ENGINE_PROFILES:
+        return jsonify({"error": f"unknown profile: {profile}", "profiles": sorted(ENGINE_PROFILES)}), 400
+    remember_channel(stream_id, data.get('channel'))
     
-    return start_stream_internal(stream_id)
+    run_async = parse_flag(data.get('async', request.args.get('async')), ASYNC_START)
+    if run_async is None:
+        return jsonify({"error": "async must be a boolean"}), 400
+    
+    record = log_request('/start_stream', stream_id=stream_id, profile=profile)
+    
+    if run_async:
+        job = submit_start_job(stream_id, profile, record["request_id"])
+        return jsonify({
+            "status": "accepted",
+            "request_id": record["request_id"],
+            "job_id": job["job_id"],
+            "stream_id": stream_id,
+            "status_url": f"/jobs/{job['job_id']}",
+            "events_url": f"/jobs/{job['job_id']}/events"
+        }), 202
+    return start_stream_traced('/start_stream', record["request_id"], stream_id, profile)
 
 @app.route('/stop_stream', methods=['POST'])
 def stop_stream():
-    data = request.json
+    data = request.get_json(silent=True) or {}
     stream_id = data.get('stream_id')
     
-    if stream_id and stream_id in active_streams:
+    if stream_id:
+        # Un id desconocido (repetido, con errata o ya recogido) no detiene nada
+        if stream_id not in active_streams:
+            return jsonify({"status": "not_found", "stream_id": stream_id}), 404
         try:
-            pid = active_streams[stream_id]
-            os.killpg(os.getpgid(pid), signal.SIGTERM)
-            del active_streams[stream_id]
-            logger.info(f"Stream detenido: {stream_id}")
+            remaining = release_stream_reference(stream_id)
+            if remaining:
+                return jsonify({"status": "released", "stream_id": stream_id, "refcount": remaining})
             return jsonify({"status": "stopped", "stream_id": stream_id})
         except Exception as e:
             logger.error(f"Error deteniendo stream: {str(e)}")
@@ -313,48 +1533,730 @@ def stop_all_streams():
                     logger.debug(f"Terminado proceso: {proc.info['name']} (PID: {proc.pid})")
                 except:
                     pass
-        active_streams.clear()
+        with streams_lock:
+            active_streams.clear()
+            stream_channels.clear()
     except Exception as e:
         logger.error(f"Error deteniendo streams: {str(e)}")
 
+# Operaciones en lote: los arranques se encolan como jobs en start_executor
+# (mismo límite de concurrencia) y se espera hasta un plazo global; los que no
+# terminan a tiempo se devuelven como "pending" con su job_id
+BATCH_MAX_IDS = int(os.environ.get('BATCH_MAX_IDS', 100))
+BATCH_DEADLINE = float(os.environ.get('BATCH_DEADLINE', 60))
+
+def batch_stream_ids(data):
+    """Lista de stream_ids del cuerpo, sin duplicados y en orden"""
+    ids = data.get('stream_ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        return None, "stream_ids list required"
+    ids = list(dict.fromkeys(str(stream_id) for stream_id in ids if stream_id))
+    if len(ids) > BATCH_MAX_IDS:
+        return None, f"too many stream_ids (max {BATCH_MAX_IDS})"
+    return ids, None
+
+@app.route('/start_streams', methods=['POST'])
+def start_streams():
+    """Arrancar varios streams en paralelo con un plazo global"""
+    data = request.get_json(silent=True) or {}
+    stream_ids, error = batch_stream_ids(data)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        deadline = min(float(data.get('deadline', BATCH_DEADLINE)), BATCH_DEADLINE)
+    except (TypeError, ValueError):
+        deadline = None
+    if deadline is None or not deadline >= 0:
+        return jsonify({"error": "deadline must be a number of seconds"}), 400
+    profile = data.get('profile')
+    if profile is not None and profile not in ENGINE_PROFILES:
+        return jsonify({"error": f"unknown profile: {profile}", "profiles": sorted(ENGINE_PROFILES)}), 400
+    record = log_request('/start_streams', stream_ids=stream_ids, profile=profile)
+    channels = data.get('channels')
+    if isinstance(channels, dict):
+        for stream_id in stream_ids:
+            remember_channel(stream_id, channels.get(stream_id))
+
+    # Un lote no expulsa streams: los ids que no caben en el pool se rechazan
+    results = {}
+    with streams_lock:
+        for entry in active_streams.values():
+            refresh_stream_state(entry)
+        running = {sid for sid, entry in active_streams.items() if entry.get("port") is not None}
+    free = len(stream_ids) if ENGINE_MODE == 'daemon' else POOL_SIZE - len(running)
+    jobs = []
+    for stream_id in stream_ids:
+        if stream_id not in running:
+            if free <= 0:
+                results[stream_id] = {"status": "rejected", "stream_id": stream_id,
+                                      "error": "engine pool full", "status_code": 503}
+                continue
+            free -= 1
+        jobs.append(submit_start_job(stream_id, profile, record["request_id"], '/start_streams'))
+    deadline_at = time.time() + deadline
+    with jobs_cond:
+        while any(job["state"] not in JOB_TERMINAL_STATES for job in jobs):
+            remaining = deadline_at - time.time()
+            if remaining <= 0:
+                break
+            jobs_cond.wait(remaining)
+
+    for job in jobs:
+        snapshot = job_response(job)
+        if snapshot["state"] in JOB_TERMINAL_STATES:
+            results[job["stream_id"]] = dict(snapshot["result"], status_code=snapshot["status_code"])
+        else:
+            results[job["stream_id"]] = {"status": "pending", "state": snapshot["state"],
+                                         "job_id": job["job_id"], "status_url": f"/jobs/{job['job_id']}"}
+    # Un motor arrancado puede haber sido expulsado después por otro arranque
+    with streams_lock:
+        for stream_id, result in results.items():
+            if result.get("method") not in ("acestream-engine", "acestream-daemon"):
+                continue
+            entry = active_streams.get(stream_id)
+            if result.get("status_code", 500) < 400 and (entry is None or entry["state"] != STATE_READY):
+                results[stream_id] = {"status": "stopped", "stream_id": stream_id,
+                                      "error": "stream stopped before the batch finished", "status_code": 410}
+    results = {stream_id: results[stream_id] for stream_id in stream_ids}
+    succeeded = sum(1 for result in results.values() if result.get("status_code", 500) < 400)
+    pending = sum(1 for result in results.values() if result.get("status") == "pending")
+    return jsonify({
+        "request_id": record["request_id"],
+        "results": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded - pending,
+        "pending": pending
+    }), 200 if succeeded == len(results) else 207
+
+@app.route('/stop_streams', methods=['POST'])
+def stop_streams():
+    """Liberar o detener varios streams en una sola llamada"""
+    data = request.get_json(silent=True) or {}
+    stream_ids, error = batch_stream_ids(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    results = {}
+    for stream_id in stream_ids:
+        if stream_id not in active_streams:
+            results[stream_id] = {"status": "not_found"}
+            continue
+        try:
+            remaining = release_stream_reference(stream_id)
+            if remaining:
+                results[stream_id] = {"status": "released", "refcount": remaining}
+            else:
+                results[stream_id] = {"status": "stopped"}
+        except Exception as e:
+            logger.error(f"Error deteniendo stream {stream_id}: {str(e)}")
+            results[stream_id] = {"status": "error", "error": str(e)}
+    failed = sum(1 for result in results.values() if result["status"] == "error")
+    return jsonify({"results": results, "failed": failed}), 200 if not failed else 207
+
+def streams_status(stream_ids):
+    """Estado resumido de los streams pedidos, leído directamente del registro"""
+    now = time.time()
+    results = {}
+    with streams_lock:
+        for stream_id in stream_ids:
+            entry = active_streams.get(stream_id)
+            if entry is None:
+                results[stream_id] = {"state": "not_found"}
+                continue
+            refresh_stream_state(entry)
+            results[stream_id] = {
+                "state": entry["state"],
+                "pid": entry.get("pid"),
+                "port": entry.get("port"),
+                "mode": entry.get("mode", "pool"),
+                "uptime": round(now - entry["ready_at"], 1) if entry.get("ready_at") else None,
+                "time_to_ready": entry.get("time_to_ready"),
+                "profile": entry.get("profile", DEFAULT_PROFILE),
+                "error": entry.get("error")
+            }
+    return results
+
+# Relay compartido: un único lector del motor por stream_id alimenta un buffer
+# circular de trozos TS y cada espectador lee desde su propio offset. Los
+# clientes lentos saltan al directo (o se cortan) sin frenar a los demás.
+TS_PACKET_SIZE = 188
+RELAY_CHUNK_SIZE = TS_PACKET_SIZE * int(os.environ.get('RELAY_CHUNK_PACKETS', 348))
+RELAY_RING_CHUNKS = int(os.environ.get('RELAY_RING_CHUNKS', 256))
+RELAY_PREROLL_CHUNKS = int(os.environ.get('RELAY_PREROLL_CHUNKS', 8))
+RELAY_MAX_SKIPS = int(os.environ.get('RELAY_MAX_SKIPS', 3))
+RELAY_IDLE = float(os.environ.get('RELAY_IDLE', 30))
+RELAY_RECONNECT_DELAY = float(os.environ.get('RELAY_RECONNECT_DELAY', 1))
+
+relays = {}
+relays_lock = threading.Lock()
+
+def relay_source_url(stream_id):
+    """URL del motor para el stream (se relee en cada reconexión)"""
+    with streams_lock:
+        entry = active_streams.get(stream_id)
+        if entry and entry["state"] == STATE_READY:
+            return entry.get("stream_url")
+    return None
+
+def relay_publish(relay, chunk):
+    with relay["cond"]:
+        relay["seq"] += 1
+        relay["chunks"].append(chunk)
+        relay["bytes_in"] += len(chunk)
+        relay["cond"].notify_all()
+
+def relay_reader(relay):
+    """Hilo lector: copia el stream del motor al buffer circular"""
+    stream_id = relay["stream_id"]
+    while True:
+        with relay["cond"]:
+            if relay["clients"] == 0 and time.time() - relay["last_client"] > RELAY_IDLE:
+                break
+        url = relay_source_url(stream_id)
+        if not url:
+            relay["error"] = "stream not running"
+            break
+        pending = b""
+        try:
+            with requests.get(url, stream=True, timeout=(5, 30)) as response:
+                response.raise_for_status()
+                relay["upstream_url"] = url
+                relay["error"] = None
+                for data in response.iter_content(chunk_size=RELAY_CHUNK_SIZE):
+                    pending += data
+                    if len(pending) >= RELAY_CHUNK_SIZE:
+                        # Publicar solo paquetes TS completos para que los saltos queden alineados
+                        cut = len(pending) - len(pending) % TS_PACKET_SIZE
+                        relay_publish(relay, pending[:cut])
+                        pending = pending[cut:]
+                    with relay["cond"]:
+                        if relay["clients"] == 0 and time.time() - relay["last_client"] > RELAY_IDLE:
+                            break
+        except requests.RequestException as e:
+            relay["error"] = str(e)
+            logger.warning(f"Relay {stream_id}: error leyendo del motor: {str(e)}")
+        relay["reconnects"] += 1
+        time.sleep(RELAY_RECONNECT_DELAY)
+    
+    with relays_lock:
+        if relays.get(stream_id) is relay:
+            del relays[stream_id]
+    with relay["cond"]:
+        relay["running"] = False
+        relay["cond"].notify_all()
+    logger.info(f"Relay {stream_id} detenido")
+
+def get_relay(stream_id):
+    """Devolver el relay del stream, creándolo si no existe"""
+    with relays_lock:
+        relay = relays.get(stream_id)
+        if relay is None:
+            relay = relays[stream_id] = {
+                "stream_id": stream_id,
+                "chunks": collections.deque(maxlen=RELAY_RING_CHUNKS),
+                "seq": 0,
+                "clients": 0,
+                "last_client": time.time(),
+                "bytes_in": 0,
+                "skips": 0,
+                "dropped": 0,
+                "reconnects": 0,
+                "upstream_url": None,
+                "error": None,
+                "running": True,
+                "cond": threading.Condition()
+            }
+            threading.Thread(target=relay_reader, args=(relay,), daemon=True).start()
+        with relay["cond"]:
+            relay["clients"] += 1
+        return relay
+
+def relay_client(relay):
+    """Generador de un espectador: lee del buffer a su propio ritmo"""
+    try:
+        with relay["cond"]:
+            position = max(relay["seq"] - len(relay["chunks"]), relay["seq"] - RELAY_PREROLL_CHUNKS)
+        skips = 0
+        while True:
+            with relay["cond"]:
+                while relay["seq"] <= position and relay["running"]:
+                    relay["cond"].wait(5)
+                if relay["seq"] <= position:
+                    return
+                oldest = relay["seq"] - len(relay["chunks"]) + 1
+                if position + 1 < oldest:
+                    # Cliente demasiado lento: saltar al directo o cortarlo
+                    skips += 1
+                    relay["skips"] += 1
+                    if skips > RELAY_MAX_SKIPS:
+                        relay["dropped"] += 1
+                        logger.info(f"Relay {relay['stream_id']}: cliente lento desconectado")
+                        return
+                    position = max(oldest - 1, relay["seq"] - RELAY_PREROLL_CHUNKS)
+                start = position + 1 - oldest
+                chunks = list(itertools.islice(relay["chunks"], start, None))
+                position = relay["seq"]
+            touch_stream(relay["stream_id"])
+            for chunk in chunks:
+                yield chunk
+    finally:
+        with relay["cond"]:
+            relay["clients"] -= 1
+            relay["last_client"] = time.time()
+
+@app.route('/relay/<stream_id>', methods=['GET'])
+def relay_stream(stream_id):
+    """Servir un stream a muchos espectadores con una sola conexión al motor"""
+    if not relay_source_url(stream_id):
+        return jsonify({"error": "stream not running", "stream_id": stream_id}), 404
+    relay = get_relay(stream_id)
+    return Response(relay_client(relay), mimetype='video/mp2t', headers={"X-Accel-Buffering": "no"})
+
+@app.route('/relays', methods=['GET'])
+def list_relays():
+    """Estado de los relays activos"""
+    with relays_lock:
+        current = list(relays.values())
+    return jsonify({relay["stream_id"]: {
+        key: relay[key] for key in ("clients", "seq", "bytes_in", "skips", "dropped", "reconnects",
+                                    "upstream_url", "error")
+    } for relay in current})
+
+# Monitor de streams: muestrea las estadísticas del motor (pares, velocidad de
+# bajada y estado del buffer) de cada stream listo. Si un stream se atasca
+# varias muestras seguidas se abre en el mismo motor el siguiente mejor
+# infohash de su canal (buscado con acestream_search) y se repunta stream_url;
+# al cerrar la sesión atascada el relay reconecta y lee la nueva URL
+MONITOR_ENABLED = os.environ.get('ACESTREAM_MONITOR', '1') == '1'
+MONITOR_INTERVAL = float(os.environ.get('MONITOR_INTERVAL', 10))
+MONITOR_GRACE = float(os.environ.get('MONITOR_GRACE', 30))
+MONITOR_STALL_SAMPLES = int(os.environ.get('MONITOR_STALL_SAMPLES', 3))
+MONITOR_MIN_PEERS = int(os.environ.get('MONITOR_MIN_PEERS', 1))
+MONITOR_MIN_SPEED = float(os.environ.get('MONITOR_MIN_SPEED', 32))  # KB/s
+FAILOVER_MAX = int(os.environ.get('FAILOVER_MAX', 3))
+# Servicio de búsqueda (search.py) si acestream_search no está instalado aquí
+SEARCH_SERVICE_URL = os.environ.get('SEARCH_SERVICE_URL', '')
+
+STREAM_STALLS = metrics.Counter('acestream_stream_stalls_total', 'Stalls detected by the stream monitor.',
+                                ('reason',))
+STREAM_FAILOVERS = metrics.Counter('acestream_stream_failovers_total',
+                                   'Failovers to an alternate infohash by result.', ('result',))
+
+try:
+    from acestream_search.acestream_search import main as search_engine, get_options as search_options
+except ImportError:
+    search_engine = search_options = None
+
+# stream_id -> nombre del canal indicado al arrancar (para buscar alternativas)
+stream_channels = {}
+
+def remember_channel(stream_id, channel):
+    if channel:
+        with streams_lock:
+            stream_channels[stream_id] = str(channel)
+
+def stall_reason(stats):
+    """Motivo por el que una muestra cuenta como atasco, o None si el stream va bien"""
+    if not stats:
+        return "no_stats"
+    if stats.get("status") != "dl":
+        return "buffering"
+    if (stats.get("peers") or 0) < MONITOR_MIN_PEERS:
+        return "low_peers"
+    if (stats.get("speed_down") or 0) < MONITOR_MIN_SPEED:
+        return "low_speed"
+    return None
+
+def stream_stat_url(entry):
+    """stat_url del stream; en el pool se abre la sesión JSON la primera vez"""
+    if entry.get("stat_url"):
+        return entry["stat_url"]
+    session = open_engine_session(entry["port"], entry["stream_id"])
+    with streams_lock:
+        entry.update({"stat_url": session.get("stat_url"), "command_url": session.get("command_url"),
+                      "infohash": session.get("infohash")})
+    return entry["stat_url"]
+
+def sample_stream(entry):
+    """Tomar una muestra del stream; devuelve el motivo si el atasco se confirma"""
+    try:
+        response = requests.get(stream_stat_url(entry), timeout=5)
+        stats = response.json().get("response")
+    except Exception as e:
+        logger.debug(f"Sin estadísticas de {entry['stream_id']}: {str(e)}")
+        stats = None
+    reason = stall_reason(stats)
+    with streams_lock:
+        if isinstance(stats, dict):
+            entry["stats"] = {"status": stats.get("status"), "peers": stats.get("peers"),
+                              "speed_down": stats.get("speed_down"), "sampled_at": time.time()}
+        entry["stall_samples"] = entry.get("stall_samples", 0) + 1 if reason else 0
+        if entry["stall_samples"] < MONITOR_STALL_SAMPLES:
+            return None
+        entry["stall_samples"] = 0
+    return reason
+
+def channel_alternates(channel, exclude=()):
+    """Infohashes del canal por disponibilidad descendente, sin los ya probados.
+
+    Devuelve None si no hay forma de buscar (ni acestream_search ni SEARCH_SERVICE_URL).
+    """
+    if search_engine is not None:
+        args = search_options({"prog": "control_api", "query": channel, "name": [channel], "json": "1"})
+        text = "".join(search_engine(args))
+    elif SEARCH_SERVICE_URL:
+        response = requests.get(SEARCH_SERVICE_URL, params={"name": f'"{channel}"', "json": "1", "live": "1"},
+                                timeout=30)
+        response.raise_for_status()
+        text = response.text
+    else:
+        return None
+    items = [item for group in json.loads(text) for item in group.get("items", []) if item.get("infohash")]
+    items.sort(key=lambda item: -(item.get("availability") or 0))
+    return [item["infohash"] for item in items if item["infohash"] not in exclude]
+
+def failover_stream(entry, reason):
+    """Pasar un stream atascado al siguiente mejor infohash de su canal"""
+    stream_id = entry["stream_id"]
+    channel = stream_channels.get(stream_id)
+    if not channel:
+        STREAM_FAILOVERS.inc(result="no_channel")
+        return False
+    if entry.get("failovers", 0) >= FAILOVER_MAX:
+        STREAM_FAILOVERS.inc(result="exhausted")
+        return False
+    # stream_id es el id de contenido; el infohash atascado es el de la sesión
+    tried = [stream_id, entry.get("infohash")] + entry.get("tried", [])
+    try:
+        alternates = channel_alternates(channel, tried)
+    except Exception as e:
+        logger.error(f"Error buscando alternativas para {channel}: {str(e)}")
+        STREAM_FAILOVERS.inc(result="error")
+        return False
+    if not alternates:
+        STREAM_FAILOVERS.inc(result="no_search" if alternates is None else "no_alternate")
+        return False
+    infohash = alternates[0]
+    try:
+        session = open_engine_session(entry["port"], infohash, key="infohash")
+    except Exception as e:
+        logger.error(f"No se pudo abrir {infohash} para {stream_id}: {str(e)}")
+        with streams_lock:
+            entry["tried"] = entry.get("tried", []) + [infohash]
+        STREAM_FAILOVERS.inc(result="error")
+        return False
+    with streams_lock:
+        current = active_streams.get(stream_id) is entry and entry["state"] == STATE_READY
+        old = {"stream_id": stream_id, "command_url": entry.get("command_url")}
+        if current:
+            entry.update({
+                "infohash": infohash,
+                "tried": entry.get("tried", []) + [infohash],
+                "failovers": entry.get("failovers", 0) + 1,
+                "failover_at": time.time(),
+                "failover_reason": reason,
+                "stream_url": session["playback_url"],
+                "playback_url": session["playback_url"],
+                "stat_url": session.get("stat_url"),
+                "command_url": session.get("command_url"),
+                "stats": None
+            })
+    if not current:
+        # El stream se detuvo mientras se buscaba: cerrar la sesión recién abierta
+        close_engine_session({"stream_id": stream_id, "command_url": session.get("command_url")})
+        return False
+    # Cerrar la sesión atascada corta la conexión del relay, que reconecta a la nueva URL
+    close_engine_session(old)
+    STREAM_FAILOVERS.inc(result="switched")
+    logger.warning(f"Stream {stream_id} ({channel}) atascado ({reason}), cambiado a {infohash}")
+    return True
+
+def monitor_cycle():
+    now = time.time()
+    with streams_lock:
+        entries = [entry for entry in active_streams.values()
+                   if entry["state"] == STATE_READY and entry.get("port")
+                   and now - max(entry.get("ready_at") or now, entry.get("stalled_at") or 0) >= MONITOR_GRACE]
+    for entry in entries:
+        reason = sample_stream(entry)
+        if reason:
+            STREAM_STALLS.inc(reason=reason)
+            # Tras cada atasco (con o sin cambio) se vuelve a dar MONITOR_GRACE al stream
+            with streams_lock:
+                entry["stalled_at"] = time.time()
+            failover_stream(entry, reason)
+
+def stream_monitor():
+    """Hilo del monitor de streams"""
+    while True:
+        try:
+            monitor_cycle()
+        except Exception as e:
+            logger.error(f"Error en el monitor de streams: {str(e)}")
+        time.sleep(MONITOR_INTERVAL)
+
+# Reaper de streams ociosos: un stream sin espectadores durante el margen de su
+# perfil se detiene y libera su puerto y su entrada del registro. Cuentan como
+# actividad el relay (touch_stream), /touch_stream (lo llama el proxy de
+# manifiestos de search.py) y las conexiones establecidas al puerto del motor.
+# Los canales fijados y los precalentados (con su propio PREWARM_IDLE) se respetan
+IDLE_REAPER_ENABLED = os.environ.get('ACESTREAM_IDLE_REAPER', '1') == '1'
+IDLE_REAPER_INTERVAL = float(os.environ.get('IDLE_REAPER_INTERVAL', 30))
+IDLE_GRACE = float(os.environ.get('IDLE_GRACE', 600))
+# Margen por perfil en segundos (0 desactiva el reaper para ese perfil);
+# IDLE_GRACE_PROFILES='{"perfil": segundos}' añade o sustituye valores
+IDLE_GRACE_PROFILES = {"low-latency": 300, "low-memory": 120, "high-viewer-count": 1800}
+try:
+    IDLE_GRACE_PROFILES.update(json.loads(os.environ.get('IDLE_GRACE_PROFILES', '{}')))
+except ValueError as e:
+    logger.error(f"IDLE_GRACE_PROFILES inválido: {str(e)}")
+
+STREAMS_REAPED = metrics.Counter('acestream_streams_reaped_total', 'Idle streams stopped by the reaper.',
+                                 ('profile',))
+
+def idle_grace(profile):
+    return float(IDLE_GRACE_PROFILES.get(profile, IDLE_GRACE))
+
+def engine_connections():
+    """Conexiones TCP establecidas por puerto local de motor"""
+    ports = set(ENGINE_PORTS) | {DAEMON_PORT}
+    counts = collections.Counter()
+    try:
+        for conn in psutil.net_connections(kind="tcp"):
+            if conn.status == psutil.CONN_ESTABLISHED and conn.laddr and conn.laddr.port in ports:
+                counts[conn.laddr.port] += 1
+    except psutil.Error as e:
+        logger.debug(f"No se pudieron leer las conexiones: {str(e)}")
+    return counts
+
+def reap_idle_streams():
+    """Detener los streams sin espectadores; devuelve los stream_ids detenidos"""
+    now = time.time()
+    connections = engine_connections()
+    with relays_lock:
+        watched = {stream_id for stream_id, relay in relays.items() if relay["clients"]}
+    idle = []
+    with streams_lock:
+        for stream_id, entry in active_streams.items():
+            if entry["state"] != STATE_READY or stream_id in PINNED_STREAMS or entry.get("prewarmed"):
+                continue
+            if entry.get("mode") == "daemon":
+                # Puerto compartido: las conexiones no se pueden atribuir a una sesión, así que
+                # mientras haya alguna ninguna sesión con referencias se da por abandonada
+                busy = entry.get("refcount", 0) > 0 and connections.get(DAEMON_PORT)
+            else:
+                busy = connections.get(entry.get("port"))
+            if stream_id in watched or busy:
+                entry["last_access"] = now
+                continue
+            grace = idle_grace(entry.get("profile", DEFAULT_PROFILE))
+            if grace > 0 and now - entry.get("last_access", entry["started_at"]) > grace:
+                idle.append((stream_id, entry, grace))
+    reaped = []
+    for stream_id, entry, grace in idle:
+        with streams_lock:
+            # Puede haber recibido un espectador mientras tanto
+            if active_streams.get(stream_id) is not entry or time.time() - entry["last_access"] <= grace:
+                continue
+            # Una sesión del daemon con más referencias suelta una por cada margen
+            entry["last_access"] = time.time()
+        remaining = release_stream_reference(stream_id)
+        if remaining:
+            logger.info(f"Sesión sin actividad durante {grace:.0f}s, referencia liberada: {stream_id} "
+                        f"({remaining} restantes)")
+            continue
+        logger.info(f"Stream sin espectadores durante {grace:.0f}s, detenido: {stream_id}")
+        STREAMS_REAPED.inc(profile=entry.get("profile", DEFAULT_PROFILE))
+        reaped.append(stream_id)
+    return reaped
+
+def idle_reaper():
+    """Hilo del reaper de streams ociosos"""
+    while True:
+        try:
+            reap_idle_streams()
+        except Exception as e:
+            logger.error(f"Error en el reaper de streams: {str(e)}")
+        time.sleep(IDLE_REAPER_INTERVAL)
+
+@app.route('/touch_stream', methods=['POST'])
+def touch_stream_route():
+    """Registrar actividad de un espectador (stream_id o infohash tras un failover)"""
+    data = request.get_json(silent=True) or {}
+    stream_id = data.get('stream_id')
+    if not stream_id:
+        return jsonify({"error": "stream_id required"}), 400
+    with streams_lock:
+        if stream_id not in active_streams:
+            stream_id = next((sid for sid, entry in active_streams.items()
+                              if entry.get("infohash") == stream_id), None)
+    if stream_id is None:
+        return jsonify({"error": "stream not running", "stream_id": data['stream_id']}), 404
+    touch_stream(stream_id)
+    return jsonify({"status": "touched", "stream_id": stream_id})
+
+# Snapshot de estado: un hilo lo reconstruye cada STATUS_INTERVAL segundos y
+# /status devuelve el JSON ya serializado sin tocar procesos ni sockets
+STATUS_INTERVAL = float(os.environ.get('STATUS_INTERVAL', 2))
+
+status_snapshot = None
+
+def stream_health(entry):
+    """Salud de un stream: proceso vivo y puerto escuchando"""
+    pid = entry.get("pid")
+    if entry.get("mode") == "daemon":
+        alive = daemon_alive()
+    elif entry.get("process") is not None:
+        alive = entry["process"].poll() is None
+    else:
+        alive = bool(pid) and psutil.pid_exists(pid)
+    port = entry.get("port")
+    return {
+        "alive": alive,
+        "port_listening": port_in_use(port) if port and alive else False,
+        "uptime": round(time.time() - entry["ready_at"], 1) if entry.get("ready_at") else None
+    }
+
+def build_status_snapshot():
+    """Construir el estado completo del servicio y serializarlo una vez"""
+    acestream_available, acestream_status = is_acestream_working(blocking=False)
+    
+    with streams_lock:
+        for entry in active_streams.values():
+            refresh_stream_state(entry)
+        entries = list(active_streams.values())
+        streams = [stream_info(entry) for entry in entries]
+    for info, entry in zip(streams, entries):
+        info["health"] = stream_health(entry)
+    
+    return json.dumps({
+        "active_streams": len(streams),
+        "streams": [entry["stream_id"] for entry in streams],
+        "stream_details": streams,
+        "engine_mode": ENGINE_MODE,
+        "daemon": {
+            "alive": daemon_alive(),
+            "pid": daemon_state["process"].pid if daemon_state["process"] else None,
+            "restarts": daemon_state["restarts"],
+            "started_at": daemon_state["started_at"]
+        },
+        "pool_size": POOL_SIZE,
+        "engine_ports": ENGINE_PORTS,
+        "default_profile": DEFAULT_PROFILE,
+        "daemon_profile": DAEMON_PROFILE,
+        "prewarmed": [entry["stream_id"] for entry in streams if entry.get("prewarmed")],
+        "acestream_available": acestream_available,
+        "acestream_status": acestream_status,
+        "port_6878_active": check_acestream_port(),
+        "system": "running",
+        "generated_at": time.time()
+    })
+
+def refresh_status_snapshot():
+    global status_snapshot
+    status_snapshot = build_status_snapshot()
+    return status_snapshot
+
+def status_snapshotter():
+    """Hilo que mantiene actualizado el snapshot de /status"""
+    while True:
+        try:
+            refresh_status_snapshot()
+        except Exception as e:
+            logger.error(f"Error construyendo snapshot de estado: {str(e)}")
+        time.sleep(STATUS_INTERVAL)
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    """Perfiles de ajuste disponibles y sus opciones de motor"""
+    return jsonify({
+        "default": DEFAULT_PROFILE,
+        "daemon": DAEMON_PROFILE,
+        "profiles": {name: profile_flags(name) for name in sorted(ENGINE_PROFILES)},
+        "idle_grace": {name: idle_grace(name) for name in sorted(ENGINE_PROFILES)}
+    })
+
 @app.route('/status', methods=['GET'])
 def get_status():
-    acestream_available, acestream_status = is_acestream_working()
-    port_available = check_acestream_port()
+    ids = request.args.get('ids')
+    if ids:
+        stream_ids = list(dict.fromkeys(i.strip() for i in ids.split(',') if i.strip()))[:BATCH_MAX_IDS]
+        return jsonify({"streams": streams_status(stream_ids), "generated_at": time.time()})
+    snapshot = status_snapshot
+    if snapshot is None or request.args.get('fresh') == '1':
+        snapshot = refresh_status_snapshot()
+    return Response(snapshot, mimetype='application/json')
+
+@app.route('/logs', methods=['GET'])
+def list_logs():
+    """Buffers de log disponibles (streams y daemon)"""
+    with engine_logs_lock:
+        buffers = list(engine_logs.items())
+    return jsonify({key: {
+        "pid": buffer["pid"],
+        "lines": len(buffer["lines"]),
+        "returncode": buffer["returncode"],
+        "started_at": buffer["started_at"],
+        "exited_at": buffer["exited_at"]
+    } for key, buffer in buffers})
+
+@app.route('/logs/<key>', methods=['GET'])
+def stream_logs(key):
+    """Últimas líneas del log de un motor; con follow=1 se siguen en directo"""
+    buffer = engine_logs.get(key)
+    if buffer is None:
+        return jsonify({"error": "no logs for stream"}), 404
+    tail = request.args.get('tail', 100, type=int)
+    
+    if request.args.get('follow') != '1':
+        return jsonify({
+            "stream_id": key,
+            "pid": buffer["pid"],
+            "returncode": buffer["returncode"],
+            "lines": engine_log_tail(key, tail)
+        })
+    
+    def generate():
+        with buffer["cond"]:
+            lines = list(buffer["lines"])[-tail:] if tail else []
+            last = buffer["seq"] - len(lines)
+        while True:
+            for seq, _, name, line in lines:
+                last = seq
+                yield f"[{name}] {line}\n"
+            with buffer["cond"]:
+                if buffer["seq"] == last:
+                    if buffer["returncode"] is not None:
+                        return
+                    buffer["cond"].wait(15)
+                lines = [item for item in buffer["lines"] if item[0] > last]
     
+    return Response(generate(), mimetype='text/plain', headers={"X-Accel-Buffering": "no"})
+
+@app.route('/startup_stats', methods=['GET'])
+def startup_stats():
+    """Distribución de los tiempos de arranque medidos"""
+    samples = list(startup_times)
+    ready_times = [s["seconds"] for s in samples if s["ready"]]
     return jsonify({
-        "active_streams": len(active_streams),
-        "streams": list(active_streams.keys()),
-        "acestream_available": acestream_available,
-        "acestream_status": acestream_status,
-        "port_6878_active": port_available,
-        "system": "running"
+        "samples": len(samples),
+        "ready": len(ready_times),
+        "failed": len(samples) - len(ready_times),
+        "min": min(ready_times) if ready_times else None,
+        "p50": percentile(ready_times, 50),
+        "p95": percentile(ready_times, 95),
+        "max": max(ready_times) if ready_times else None,
+        "recent": samples[-20:]
     })
 
 @app.route('/test_acestream', methods=['GET'])
 def test_acestream():
     try:
-        acestream_binary = find_acestream_binary()
+        inventory = get_engine_inventory()
+        acestream_binary = inventory["binary_path"]
         if acestream_binary:
-            logger.debug(f"Probando binario: {acestream_binary}")
-            
-            # Verificar permisos del archivo
-            import stat
-            file_stat = os.stat(acestream_binary)
-            is_executable = bool(file_stat.st_mode & stat.S_IEXEC)
-            
-            # Verificar dependencias
-            ldd_result = subprocess.run(['ldd', acestream_binary], capture_output=True, text=True, timeout=10)
-            dependencies_ok = "not found" not in ldd_result.stdout
-            
-            # En lugar de --version, intentar con --help
-            try:
-                result = subprocess.run([acestream_binary, '--help'], capture_output=True, text=True, timeout=5)
-                help_works = True
-                help_output = result.stdout[:200] + "..." if len(result.stdout) > 200 else result.stdout
-            except:
-                help_works = False
-                help_output = "No disponible"
+            is_executable = inventory.get("is_executable", False)
+            dependencies_ok = inventory.get("dependencies_ok", False)
             
             if is_executable and dependencies_ok:
                 return jsonify({
@@ -363,8 +2265,9 @@ def test_acestream():
                     "path": acestream_binary,
                     "is_executable": is_executable,
                     "dependencies_ok": dependencies_ok,
-                    "help_works": help_works,
-                    "help_output": help_output
+                    "help_works": inventory.get("help_works", False),
+                    "help_output": inventory.get("help_output", "No disponible"),
+                    "inventory_built_at": inventory["built_at"]
                 })
             else:
                 return jsonify({
@@ -373,7 +2276,8 @@ def test_acestream():
                     "path": acestream_binary,
                     "is_executable": is_executable,
                     "dependencies_ok": dependencies_ok,
-                    "missing_deps": [line for line in ldd_result.stdout.split('\n') if 'not found' in line]
+                    "missing_deps": inventory.get("missing_deps", []),
+                    "inventory_built_at": inventory["built_at"]
                 })
         else:
             return jsonify({
@@ -393,58 +2297,27 @@ def test_acestream():
 def debug_acestream():
     """Endpoint para diagnosticar problemas con AceStream"""
     try:
-        acestream_binary = find_acestream_binary()
+        inventory = get_engine_inventory()
         debug_info = {
-            "binary_path": acestream_binary,
-            "binary_exists": os.path.exists(acestream_binary) if acestream_binary else False
+            "binary_path": inventory["binary_path"],
+            "binary_exists": inventory["binary_exists"],
+            "inventory_built_at": inventory["built_at"]
         }
         
-        if acestream_binary and os.path.exists(acestream_binary):
-            import stat
-            file_stat = os.stat(acestream_binary)
-            debug_info.update({
-                "file_size": file_stat.st_size,
-                "is_executable": bool(file_stat.st_mode & stat.S_IEXEC),
-                "permissions": oct(file_stat.st_mode)[-3:]
-            })
-            
-            # Verificar dependencias
-            try:
-                ldd_result = subprocess.run(['ldd', acestream_binary], capture_output=True, text=True, timeout=10)
-                debug_info["dependencies_resolved"] = "not found" not in ldd_result.stdout
-                debug_info["ldd_output"] = ldd_result.stdout
-            except Exception as e:
-                debug_info["ldd_error"] = str(e)
+        if inventory["binary_exists"]:
+            for key in ("file_size", "is_executable", "permissions", "ldd_output", "ldd_error",
+                        "file_type", "file_type_error", "missing_modules"):
+                if key in inventory:
+                    debug_info[key] = inventory[key]
+            if "ldd_output" in inventory:
+                debug_info["dependencies_resolved"] = inventory["dependencies_ok"]
             
-            # Verificar tipo de archivo
-            try:
-                file_result = subprocess.run(['file', acestream_binary], capture_output=True, text=True, timeout=5)
-                debug_info["file_type"] = file_result.stdout
-            except Exception as e:
-                debug_info["file_type_error"] = str(e)
-            
-            # Intentar ejecutar con diferentes argumentos
-            test_commands = [
-                ['--help'],
-                ['--version'],
-                ['-h'],
-                []
-            ]
-            
-            debug_info["execution_tests"] = {}
-            for cmd_args in test_commands:
-                try:
-                    result = subprocess.run([acestream_binary] + cmd_args, 
-                                          capture_output=True, text=True, timeout=5)
-                    debug_info["execution_tests"][str(cmd_args)] = {
-                        "return_code": result.returncode,
-                        "stdout": result.stdout[:500],
-                        "stderr": result.stderr[:500]
-                    }
-                except subprocess.TimeoutExpired:
-                    debug_info["execution_tests"][str(cmd_args)] = {"error": "timeout"}
-                except Exception as e:
-                    debug_info["execution_tests"][str(cmd_args)] = {"error": str(e)}
+            # Las pruebas de ejecución son caras: se hacen la primera vez que se piden
+            # y se guardan en el inventario hasta que este se invalide
+            with inventory_lock:
+                if "execution_tests" not in inventory:
+                    inventory["execution_tests"] = run_execution_tests(inventory["binary_path"])
+            debug_info["execution_tests"] = inventory["execution_tests"]
         
         return jsonify(debug_info)
         
@@ -453,16 +2326,29 @@ def debug_acestream():
             "error": f"Error en debug: {str(e)}"
         })
 
+@app.route('/refresh_inventory', methods=['POST'])
+def refresh_inventory():
+    """Forzar la reconstrucción del inventario del motor"""
+    inventory = get_engine_inventory(refresh=True)
+    return jsonify({
+        "status": "refreshed",
+        "binary_path": inventory["binary_path"],
+        "acestream_available": inventory["available"],
+        "acestream_status": inventory["status"],
+        "inventory_built_at": inventory["built_at"]
+    })
+
 @app.route('/start_daemon', methods=['POST'])
 def start_daemon():
     """Iniciar el daemon de AceStream manualmente"""
     try:
-        daemon_process = start_acestream_daemon()
+        daemon_process = ensure_daemon()
         if daemon_process:
             return jsonify({
                 "status": "started",
                 "message": "Daemon AceStream iniciado",
-                "pid": daemon_process.pid
+                "pid": daemon_process.pid,
+                "restarts": daemon_state["restarts"]
             })
         else:
             return jsonify({
@@ -484,19 +2370,7 @@ def install_missing_deps():
             return jsonify({"error": "AceStream binary not found"}), 400
         
         # Verificar qué módulos faltan
-        result = subprocess.run([acestream_binary, '--help'], capture_output=True, text=True, timeout=15)
-        missing_modules = []
-        output = result.stdout + result.stderr
-        
-        for line in output.split('\n'):
-            if "No module named" in line:
-                if "'" in line:
-                    module_name = line.split("'")[1]
-                elif '"' in line:
-                    module_name = line.split('"')[1]
-                else:
-                    module_name = line.split()[-1]
-                missing_modules.append(module_name)
+        missing_modules = get_engine_inventory().get("missing_modules", [])
         
         if not missing_modules:
             return jsonify({"message": "No missing modules detected"})
@@ -522,6 +2396,10 @@ def install_missing_deps():
                 failed.append(f"{module}: {str(e)}")
                 logger.error(f"Error instalando {module}: {str(e)}")
         
+        # Los módulos instalados cambian el resultado de --help
+        if installed:
+            get_engine_inventory(refresh=True)
+        
         return jsonify({
             "missing_modules": missing_modules,
             "installed": installed,
@@ -533,6 +2411,171 @@ def install_missing_deps():
         logger.error(f"Error instalando dependencias: {str(e)}")
         return jsonify({"error": f"Error: {str(e)}"}), 500
 
+# Persistencia del registro: un hilo guarda en disco (escritura atómica) los
+# streams vivos y el daemon cuando cambian; al arrancar se vuelven a adoptar
+# los motores que siguen en marcha en lugar de matarlos y relanzarlos
+REGISTRY_FILE = os.environ.get('REGISTRY_FILE', '/tmp/acestream_registry.json')
+REGISTRY_PERSIST_INTERVAL = float(os.environ.get('REGISTRY_PERSIST_INTERVAL', 1))
+
+registry_state = {"saved": None}
+
+class AdoptedProcess:
+    """Motor lanzado por una ejecución anterior: imita la parte de Popen que se usa"""
+    def __init__(self, proc):
+        self.proc = proc
+        self.pid = proc.pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                running = self.proc.is_running() and self.proc.status() != psutil.STATUS_ZOMBIE
+            except psutil.Error:
+                running = False
+            if not running:
+                # No es hijo nuestro: el código de salida real no se puede saber
+                self.returncode = -1
+        return self.returncode
+
+    def wait(self, timeout=None):
+        try:
+            code = self.proc.wait(timeout)
+        except psutil.TimeoutExpired:
+            raise subprocess.TimeoutExpired(f"pid {self.pid}", timeout)
+        self.returncode = -1 if code is None else code
+        return self.returncode
+
+# Campos que cambian con cada espectador o muestra: guardarlos reescribiría el
+# fichero (con fsync) cada segundo. El orden LRU tampoco se guarda.
+REGISTRY_VOLATILE = ("last_access", "stats", "stall_samples")
+
+def serialize_registry():
+    with streams_lock:
+        streams = [{key: value for key, value in stream_info(entry).items() if key not in REGISTRY_VOLATILE}
+                   for entry in active_streams.values() if entry["state"] in (STATE_READY, STATE_STARTING)]
+    streams.sort(key=lambda info: (info.get("started_at") or 0, info["stream_id"]))
+    process = daemon_state["process"]
+    daemon = None
+    if daemon_alive():
+        daemon = {"pid": process.pid, "started_at": daemon_state["started_at"],
+                  "restarts": daemon_state["restarts"]}
+    return json.dumps({"engine_mode": ENGINE_MODE, "daemon": daemon, "streams": streams},
+                      sort_keys=True, default=str)
+
+def persist_registry(force=False):
+    """Escribir el registro si ha cambiado (tmp + os.replace para no dejarlo a medias)"""
+    data = serialize_registry()
+    if data == registry_state["saved"] and not force:
+        return False
+    tmp = REGISTRY_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, REGISTRY_FILE)
+    registry_state["saved"] = data
+    return True
+
+def registry_persister():
+    while True:
+        try:
+            persist_registry()
+        except Exception as e:
+            logger.error(f"Error guardando el registro: {str(e)}")
+        time.sleep(REGISTRY_PERSIST_INTERVAL)
+
+def verify_engine(pid, port, *markers):
+    """psutil.Process del motor si el pid vive, su cmdline cuadra y el puerto escucha"""
+    try:
+        proc = psutil.Process(pid)
+        if proc.status() == psutil.STATUS_ZOMBIE:
+            return None
+        cmdline = proc.cmdline()
+    except (psutil.Error, TypeError, ValueError):
+        return None
+    expected = [f"--port={port}"] + list(markers)
+    if not all(marker in cmdline for marker in expected):
+        return None
+    if not port_in_use(port):
+        return None
+    return proc
+
+def restore_registry():
+    """Adoptar los motores de la ejecución anterior que siguen vivos"""
+    try:
+        with open(REGISTRY_FILE) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return 0
+
+    daemon = saved.get("daemon")
+    if daemon and ENGINE_MODE == 'daemon':
+        proc = verify_engine(daemon["pid"], DAEMON_PORT)
+        if proc:
+            daemon_state.update({"process": AdoptedProcess(proc), "started_at": daemon["started_at"],
+                                 "restarts": daemon.get("restarts", 0)})
+            start_log_pump("daemon", daemon_state["process"], tail_bytes=ENGINE_LOG_ADOPT_TAIL)
+            logger.info(f"Daemon AceStream readoptado (PID: {proc.pid})")
+
+    adopted = 0
+    for info in saved.get("streams", []):
+        stream_id = info.get("stream_id")
+        if info.get("state") != STATE_READY:
+            continue
+        if info.get("mode") == "daemon":
+            if ENGINE_MODE != 'daemon' or not daemon_alive():
+                continue
+            entry = dict(info)
+        else:
+            proc = verify_engine(info.get("pid"), info.get("port"), f"--stream-id={stream_id}")
+            if proc is None:
+                logger.info(f"Stream {stream_id} del registro ya no está vivo, se descarta")
+                continue
+            entry = dict(info, process=AdoptedProcess(proc))
+            # La salida va a ficheros que sobreviven al reinicio: seguir leyéndolos
+            start_log_pump(stream_id, entry["process"], tail_bytes=ENGINE_LOG_ADOPT_TAIL)
+        # Sin historial de accesos: el reaper cuenta el margen desde la readopción
+        entry.update({"reattached": True, "last_access": time.time()})
+        with streams_lock:
+            active_streams[stream_id] = entry
+        adopted += 1
+        logger.info(f"Stream readoptado: {stream_id} (PID: {entry.get('pid')}, puerto: {entry.get('port')})")
+    persist_registry(force=True)
+    return adopted
+
+# Modo de servicio: "production" (por defecto) usa waitress si está instalado o
+# el servidor multihilo de Flask sin debug; "development" mantiene el debug
+SERVER_MODE = os.environ.get('CONTROL_API_MODE', 'production')
+SERVER_THREADS = int(os.environ.get('CONTROL_API_THREADS', 32))
+
+def serve_production(port):
+    try:
+        from waitress import serve
+    except ImportError:
+        logger.warning("waitress no instalado, usando el servidor multihilo de Flask")
+        app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
+        return
+    logger.info(f"Sirviendo con waitress ({SERVER_THREADS} hilos)")
+    serve(app, host='0.0.0.0', port=port, threads=SERVER_THREADS)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    # Readoptar los motores que sobrevivieron al reinicio antes de aceptar peticiones
+    restore_registry()
+    threading.Thread(target=registry_persister, daemon=True).start()
+    # Construir el inventario al arrancar sin bloquear el servidor
+    threading.Thread(target=get_engine_inventory, daemon=True).start()
+    threading.Thread(target=resource_sampler, daemon=True).start()
+    threading.Thread(target=status_snapshotter, daemon=True).start()
+    if ENGINE_MODE == 'daemon':
+        threading.Thread(target=supervise_daemon, daemon=True).start()
+    if PREWARM_ENABLED:
+        threading.Thread(target=prewarm_loop, daemon=True).start()
+    if MONITOR_ENABLED:
+        threading.Thread(target=stream_monitor, daemon=True).start()
+    if IDLE_REAPER_ENABLED:
+        threading.Thread(target=idle_reaper, daemon=True).start()
+    if SERVER_MODE == 'development':
+        app.run(host='0.0.0.0', port=port, debug=True, use_reloader=False)
+    else:
+        serve_production(port)
\ No newline at end of file
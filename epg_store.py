@@ -0,0 +1,138 @@
+"""Incremental EPG store with streamed XMLTV output."""
+import bisect
+import calendar
+import hashlib
+import logging
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = float(os.environ.get('EPG_REFRESH_INTERVAL', 3600))
+
+_lock = threading.Lock()
+# channel id -> serialized <channel> element
+channels = {}
+# channel id -> (digest, starts, [(start, stop, serialized <programme>)]) sorted by start
+programmes = {}
+state = {'refreshed_at': None}
+
+
+def parse_time(value):
+    """XMLTV timestamp ("20240101120000 +0300") to a unix timestamp."""
+    value = (value or '').strip()
+    try:
+        return datetime.strptime(value, '%Y%m%d%H%M%S %z').timestamp()
+    except ValueError:
+        return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+
+
+def parse(pages):
+    """Parse XMLTV pages incrementally into channel and programme dicts."""
+    parser = ET.XMLPullParser(events=('end',))
+    new_channels = {}
+    new_programmes = {}
+
+    def drain():
+        for _, element in parser.read_events():
+            if element.tag == 'channel':
+                new_channels[element.get('id')] = ET.tostring(element, encoding='unicode')
+                element.clear()
+            elif element.tag == 'programme':
+                try:
+                    item = (parse_time(element.get('start')), parse_time(element.get('stop')),
+                            ET.tostring(element, encoding='unicode'))
+                except ValueError:
+                    item = None
+                if item:
+                    new_programmes.setdefault(element.get('channel'), []).append(item)
+                element.clear()
+
+    for page in pages:
+        parser.feed(page)
+        drain()
+    parser.close()
+    drain()
+    return new_channels, new_programmes
+
+
+def update(new_channels, new_programmes):
+    """Replace only channels whose programme data changed. Returns the number changed."""
+    changed = 0
+    with _lock:
+        channels.clear()
+        channels.update(new_channels)
+        for channel_id in set(programmes) - set(new_programmes):
+            del programmes[channel_id]
+        for channel_id, items in new_programmes.items():
+            items.sort()
+            digest = hashlib.sha1(''.join(xml for _, _, xml in items).encode('utf8')).hexdigest()
+            current = programmes.get(channel_id)
+            if current and current[0] == digest:
+                continue
+            programmes[channel_id] = (digest, [start for start, _, _ in items], items)
+            changed += 1
+        state['refreshed_at'] = time.time()
+    return changed
+
+
+def evict(now=None):
+    """Drop programmes that have already ended."""
+    now = time.time() if now is None else now
+    with _lock:
+        for channel_id, (digest, starts, items) in list(programmes.items()):
+            live = [item for item in items if item[1] > now]
+            if len(live) != len(items):
+                programmes[channel_id] = (digest, [start for start, _, _ in live], live)
+
+
+def refresh(fetch_xmltv):
+    started = time.time()
+    changed = update(*parse(fetch_xmltv()))
+    evict()
+    logger.info('epg refresh: %d channels changed in %.1fs', changed, time.time() - started)
+
+
+def refresher(fetch_xmltv):
+    while True:
+        try:
+            refresh(fetch_xmltv)
+        except Exception as e:
+            logger.error('epg refresh failed: %s', e)
+        time.sleep(REFRESH_INTERVAL)
+
+
+def start_refresher(fetch_xmltv):
+    thread = threading.Thread(target=refresher, args=(fetch_xmltv,), daemon=True)
+    thread.start()
+    return thread
+
+
+def ready():
+    return state['refreshed_at'] is not None
+
+
+def xmltv(channel_ids=None, start=None, stop=None):
+    """Yield an XMLTV document for channel_ids (all by default) between start and stop."""
+    start = time.time() if start is None else start
+    with _lock:
+        ids = sorted(channels) if channel_ids is None else [c for c in channel_ids if c in channels]
+        selected = [(c, channels[c], programmes.get(c)) for c in ids]
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<tv generator-info-name="acestream-service">\n'
+    for _, channel_xml, _ in selected:
+        yield channel_xml.strip() + '\n'
+    for _, _, entry in selected:
+        if not entry:
+            continue
+        _, starts, items = entry
+        # Programmes may have started before the window and still be running.
+        first = max(0, bisect.bisect_left(starts, start) - 1)
+        for programme_start, programme_stop, programme_xml in items[first:]:
+            if stop is not None and programme_start >= stop:
+                break
+            if programme_stop > start:
+                yield programme_xml.strip() + '\n'
+    yield '</tv>\n'
@@ -0,0 +1,143 @@
+"""Minimal Prometheus text-format metrics shared by control_api.py and search.py."""
+import bisect
+import threading
+import time
+
+from flask import Response, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []
+_collectors = []
+_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join('%s="%s"' % (k, v) for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with _lock:
+            self.values.clear()
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        with _lock:
+            samples = list(self.samples())
+        lines.extend('%s%s %s' % (name, labels, _format_value(value)) for name, labels, value in samples)
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            counts = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield (self.name + '_bucket', _format_labels(self.labelnames, key, ('le', _format_value(bound))),
+                       cumulative)
+            yield self.name + '_sum', _format_labels(self.labelnames, key), total
+            yield self.name + '_count', _format_labels(self.labelnames, key), count
+
+
+def on_collect(callback):
+    """Register a callback run before each scrape to refresh derived gauges."""
+    _collectors.append(callback)
+    return callback
+
+
+def render():
+    for callback in _collectors:
+        callback()
+    with _lock:
+        metrics = list(_metrics)
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+def instrument(app, prefix):
+    """Count requests and time them per route, and expose GET /metrics."""
+    requests_total = Counter(prefix + '_http_requests_total', 'HTTP requests by route, method and status.',
+                             ('route', 'method', 'status'))
+    latency = Histogram(prefix + '_http_request_duration_seconds',
+                        'Time until the response (or the first streamed byte) is ready, by route.', ('route',))
+
+    @app.before_request
+    def start_timer():
+        request.environ['metrics.start'] = time.monotonic()
+
+    @app.after_request
+    def record(response):
+        started = request.environ.get('metrics.start')
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        requests_total.inc(route=route, method=request.method, status=response.status_code)
+        if started is not None:
+            latency.observe(time.monotonic() - started, route=route)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    return requests_total, latency
@@ -0,0 +1,46 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+# One JSON object per line, keyed by request_id like the backlog tooling expects.
+REQUEST_LOG_FILE = os.environ.get('REQUEST_LOG_FILE', '/tmp/acestream_requests.jsonl')
+REQUEST_LOG_MAX_BYTES = int(os.environ.get('REQUEST_LOG_MAX_BYTES', 10 * 1024 * 1024))
+
+_lock = threading.Lock()
+
+
+def log_request(route, **fields):
+    record = {'request_id': uuid.uuid4().hex, 'timestamp': time.time(), 'route': route}
+    record.update(fields)
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    try:
+        with _lock:
+            if os.path.exists(REQUEST_LOG_FILE) and os.path.getsize(REQUEST_LOG_FILE) > REQUEST_LOG_MAX_BYTES:
+                os.replace(REQUEST_LOG_FILE, REQUEST_LOG_FILE + '.1')
+            with open(REQUEST_LOG_FILE, 'a') as f:
+                f.write(line)
+    except OSError:
+        pass
+    return record
+
+
+def read_requests(since=0, route=None):
+    records = []
+    for path in (REQUEST_LOG_FILE + '.1', REQUEST_LOG_FILE):
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('timestamp', 0) < since:
+                        continue
+                    if route and record.get('route') != route:
+                        continue
+                    records.append(record)
+        except OSError:
+            continue
+    return records
@@ -1,11 +1,38 @@
+import copy
+import hashlib
+import logging
+import os
+import queue
 import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from distutils.util import split_quoted
+from email.utils import formatdate, parsedate_to_datetime
 
+import requests
 from flask import Flask, request, Response
 
 from acestream_search.acestream_search import main as engine, get_options, __version__
+import channel_index
+import epg_store
+import metrics
+import tracing
+from request_log import log_request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+metrics.instrument(app, 'acestream_search')
+CACHE_REQUESTS = metrics.Counter('acestream_search_cache_requests_total',
+                                 'Search cache lookups by result (hit, stale, coalesced, miss).', ('result',))
 if sys.version_info[0] > 2:
     def u_code(string):
         return string
@@ -14,9 +41,15 @@ else:
         return string.encode("utf8")
 
 
+# Request parameters handled here and never passed on to acestream_search.
+LOCAL_ARGS = ('live', 'channels', 'hours')
+
+
 def get_args():
     opts = {'prog': request.base_url}
     for item in request.args:
+        if item in LOCAL_ARGS:
+            continue
         opts[item] = u_code(request.args[item])
     if 'name' in opts:
         opts['name'] = split_quoted(opts['name'])
@@ -26,11 +59,540 @@ def get_args():
     return args
 
 
+# In-process result cache: per-format TTL, stale-while-revalidate and
+# single-flight filling so identical concurrent requests share one search.
+CACHE_TTL = {
+    'm3u': float(os.environ.get('SEARCH_CACHE_TTL_M3U', 300)),
+    'json': float(os.environ.get('SEARCH_CACHE_TTL_JSON', 300)),
+    'xml': float(os.environ.get('SEARCH_CACHE_TTL_XML', 900)),
+}
+CACHE_STALE = float(os.environ.get('SEARCH_CACHE_STALE', 600))
+CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 128))
+CACHE_MAX_BYTES = int(os.environ.get('SEARCH_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+cache = OrderedDict()
+cache_size = [0]
+flights = {}
+cache_lock = threading.Lock()
+
+
+class Flight(object):
+    """A search in progress whose pages are followed by any number of clients."""
+
+    def __init__(self):
+        self.pages = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def add(self, page):
+        with self.cond:
+            self.pages.append(page)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def follow(self):
+        index = 0
+        while True:
+            with self.cond:
+                while index >= len(self.pages) and not self.done:
+                    self.cond.wait()
+                pages = self.pages[index:]
+                done, error = self.done, self.error
+            for page in pages:
+                yield page
+            index += len(pages)
+            if done and index >= len(self.pages):
+                if error is not None:
+                    raise error
+                return
+
+
+# acestream_search options that only switch something on: any non-empty value does.
+FLAG_OPTIONS = ('quiet', 'group_by_channels', 'show_epg', 'show_category', 'json', 'xml_epg', 'debug', 'url')
+
+
+def cache_key(args):
+    """Key on the parsed options, so spellings of the same search share an entry.
+
+    The route (.m3u or .m3u8) and the Host do not change the output, and 'after'
+    only counts when given: its default moves with the clock.
+    """
+    options = []
+    for name, value in sorted(vars(args).items()):
+        if name in ('prog', 'query', 'name') or name == 'after' and 'after' not in request.args:
+            continue
+        if name in FLAG_OPTIONS:
+            value = bool(value)
+        options.append((name, tuple(value) if isinstance(value, list) else value))
+    # Every query= and name= value, not just the first one get_args() keeps.
+    queries = tuple(u_code(q) for q in request.args.getlist('query'))
+    names = tuple(n for value in request.args.getlist('name') for n in split_quoted(u_code(value)))
+    local = tuple((name, request.args.get(name)) for name in LOCAL_ARGS if name in request.args)
+    return tuple(options), queries, names, local
+
+
+def cache_format(args):
+    if args.xml_epg:
+        return 'xml'
+    if args.json:
+        return 'json'
+    return 'm3u'
+
+
+def cache_store(key, fmt, pages):
+    size = sum(len(page) for page in pages)
+    digest = hashlib.sha1(''.join(pages).encode('utf8')).hexdigest()
+    now = time.time()
+    with cache_lock:
+        old = cache.pop(key, None)
+        if old:
+            cache_size[0] -= old['size']
+        # Unchanged results keep their Last-Modified so clients still get 304s.
+        modified = old['modified'] if old and old['digest'] == digest else now
+        cache[key] = {'key': key, 'pages': pages, 'size': size, 'created': now, 'format': fmt,
+                      'digest': digest, 'modified': modified, 'variants': {}}
+        cache_size[0] += size
+        cache_trim()
+
+
+def cache_trim():
+    while cache and (len(cache) > CACHE_MAX_ENTRIES or cache_size[0] > CACHE_MAX_BYTES):
+        _, evicted = cache.popitem(last=False)
+        cache_size[0] -= evicted['size']
+
+
+class PartialResults(Exception):
+    """Raised by a producer after its last page when those pages must not be cached."""
+
+
+def fill(key, fmt, produce, flight):
+    pages = []
+    try:
+        for page in produce():
+            pages.append(page)
+            flight.add(page)
+    except PartialResults:
+        flight.finish()
+    except Exception as e:
+        flight.finish(e)
+    else:
+        cache_store(key, fmt, pages)
+        flight.finish()
+    finally:
+        with cache_lock:
+            flights.pop(key, None)
+
+
+def cached_pages(key, fmt, produce):
+    """Return (entry, pages) for key, searching at most once at a time.
+
+    entry is the cache entry the pages come from, or None while a search is in flight.
+    """
+    with cache_lock:
+        entry = cache.get(key)
+        flight = flights.get(key)
+        if entry:
+            age = time.time() - entry['created']
+            if age < CACHE_TTL[fmt] + CACHE_STALE:
+                cache.move_to_end(key)
+                if age >= CACHE_TTL[fmt] and flight is None:
+                    # Stale: serve it and refresh in the background.
+                    flight = flights[key] = Flight()
+                    threading.Thread(target=fill, args=(key, fmt, produce, flight), daemon=True).start()
+                CACHE_REQUESTS.inc(result='hit' if age < CACHE_TTL[fmt] else 'stale')
+                return entry, iter(entry['pages'])
+        if flight is None:
+            flight = flights[key] = Flight()
+            threading.Thread(target=fill, args=(key, fmt, produce, flight), daemon=True).start()
+            CACHE_REQUESTS.inc(result='miss')
+        else:
+            CACHE_REQUESTS.inc(result='coalesced')
+    return None, flight.follow()
+
+
+# Conditional GET and compression. Cached results carry a content digest, so
+# If-None-Match / If-Modified-Since are answered with 304 before any search,
+# and their compressed bodies are kept per encoding and public base.
+COMPRESS_LEVEL = int(os.environ.get('SEARCH_COMPRESS_LEVEL', 6))
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+
+def accepted_encoding():
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def make_etag(*parts):
+    return 'W/"%s"' % hashlib.sha1('\0'.join(str(p) for p in parts).encode('utf8')).hexdigest()[:24]
+
+
+def not_modified(etag, modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag.split('"')[1])
+    since = request.headers.get('If-Modified-Since')
+    if since and modified:
+        try:
+            return parsedate_to_datetime(since).timestamp() >= int(modified)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def compressor(encoding):
+    if encoding == 'br':
+        c = brotli.Compressor(quality=min(COMPRESS_LEVEL, 11))
+        return c.process, c.flush, c.finish
+    c = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    return c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+
+
+def compress_stream(pages, encoding):
+    """Compress pages as they are produced, flushing after each one."""
+    process, flush, finish = compressor(encoding)
+    for page in pages:
+        data = process(page.encode('utf8')) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+CACHE_SLICE = 64 * 1024
+
+
+def body_slices(body):
+    for offset in range(0, len(body), CACHE_SLICE):
+        yield body[offset:offset + CACHE_SLICE]
+
+
+def cached_body(entry, encoding, base):
+    """Stream the (rewritten, compressed) body of a cache entry in CACHE_SLICE pieces.
+
+    Variants are built once and kept with the entry only for a fixed base (none,
+    or PUBLIC_HOST); a base taken from the request Host is rewritten and
+    compressed per request, so arbitrary Host headers cannot add variants.
+    """
+    if base is not None and not os.environ.get('PUBLIC_HOST'):
+        pages = rewrite_lines(entry['pages'], base)
+        return compress_stream(pages, encoding) if encoding else pages
+    variant = (encoding, base)
+    body = entry['variants'].get(variant)
+    if body is not None:
+        return body_slices(body)
+    pages = entry['pages']
+    if base is not None:
+        pages = rewrite_lines(pages, base)
+    body = ''.join(pages).encode('utf8')
+    if encoding:
+        process, _, finish = compressor(encoding)
+        body = process(body) + finish()
+    with cache_lock:
+        if entry['variants'].setdefault(variant, body) is body and cache.get(entry['key']) is entry:
+            entry['size'] += len(body)
+            cache_size[0] += len(body)
+            cache_trim()
+    return body_slices(body)
+
+
+# Engine URLs in playlists and HLS manifests are rewritten to the public
+# SCHEME://host:ENTRY/ line by line while streaming (formerly nginx sub_filter).
+ENGINE_URL = os.environ.get('ENGINE_URL', 'http://127.0.0.1:6878').rstrip('/')
+ENGINE_PREFIXES = [p.strip().rstrip('/') + '/' for p in
+                   os.environ.get('ENGINE_PREFIXES', 'http://localhost:6878,http://127.0.0.1:6878').split(',')
+                   if p.strip()]
+REWRITE_URLS = os.environ.get('REWRITE_URLS', '1') == '1'
+
+
+def public_base():
+    scheme = os.environ.get('SCHEME', 'https')
+    host = os.environ.get('PUBLIC_HOST') or request.host.split(':')[0]
+    entry = os.environ.get('ENTRY', '').lstrip(':')
+    return '%s://%s%s/' % (scheme, host, ':' + entry if entry else '')
+
+
+def rewrite_lines(lines, base):
+    for line in lines:
+        if 'http' in line:
+            for prefix in ENGINE_PREFIXES:
+                line = line.replace(prefix, base)
+        yield line
+
+
+# Viewer activity for the control API's idle reaper: HLS players fetch the
+# manifest every few seconds, so each stream is touched at most once per
+# CONTROL_TOUCH_INTERVAL, from a background thread.
+CONTROL_URL = os.environ.get('CONTROL_URL', '').rstrip('/')
+CONTROL_TOUCH_INTERVAL = float(os.environ.get('CONTROL_TOUCH_INTERVAL', 10))
+
+touched = {}
+
+
+def touch_control(stream_id):
+    try:
+        requests.post(CONTROL_URL + '/touch_stream', json={'stream_id': stream_id}, timeout=2)
+    except requests.RequestException:
+        pass
+
+
+def touch_stream(stream_id):
+    if not CONTROL_URL or not stream_id:
+        return
+    now = time.monotonic()
+    if now - touched.get(stream_id, -CONTROL_TOUCH_INTERVAL) < CONTROL_TOUCH_INTERVAL:
+        return
+    if len(touched) > 1000:
+        touched.clear()
+    touched[stream_id] = now
+    threading.Thread(target=touch_control, args=(stream_id,), daemon=True).start()
+
+
+@app.route('/ace/manifest.m3u8')
+def manifest():
+    touch_stream(request.args.get('id') or request.args.get('infohash'))
+    try:
+        upstream = requests.get(ENGINE_URL + '/ace/manifest.m3u8', params=request.args.items(multi=True),
+                                stream=True, timeout=(5, 60))
+    except requests.RequestException as e:
+        return Response('engine unavailable: %s\n' % e, status=502, content_type='text/plain')
+    upstream.encoding = upstream.encoding or 'utf-8'
+    base = public_base()
+
+    def generate():
+        with upstream:
+            for line in rewrite_lines(upstream.iter_lines(decode_unicode=True), base):
+                yield line + '\n'
+
+    return Response(generate(), status=upstream.status_code,
+                    content_type=upstream.headers.get('Content-Type', 'application/vnd.apple.mpegurl'))
+
+
+# Local channel index: answers plain searches in milliseconds from SQLite and
+# falls back to the live search on a miss or with live=1.
+INDEX_ENABLED = os.environ.get('CHANNEL_INDEX', '0') == '1'
+INDEX_ARGS = {'query', 'name', 'group_by_channels', 'show_epg', 'json', 'live'}
+INDEX_REQUESTS = metrics.Counter('acestream_search_index_requests_total',
+                                 'Channel index lookups by result (hit, miss, skipped).', ('result',))
+
+
+def fetch_catalogue():
+    return list(engine(get_options({'prog': 'channel_index', 'query': '', 'json': '1'})))
+
+
+def index_pages(args):
+    if set(request.args) - INDEX_ARGS or args.xml_epg or channel_index.last_crawl() is None:
+        INDEX_REQUESTS.inc(result='skipped')
+        return None
+    names = args.name if 'name' in request.args else None
+    rows = channel_index.search(request.args.get('query', ''), names)
+    if not rows:
+        INDEX_REQUESTS.inc(result='miss')
+        return None
+    INDEX_REQUESTS.inc(result='hit')
+    if args.json:
+        return channel_index.render_json(rows)
+    target = getattr(args, 'target', None) or ENGINE_URL.split('://', 1)[-1]
+    return channel_index.render_m3u(rows, target, show_epg=bool(args.show_epg),
+                                    group_by_channels=bool(args.group_by_channels))
+
+
+if INDEX_ENABLED:
+    channel_index.start_crawler(fetch_catalogue)
+
+
+# EPG store: the full guide is fetched once per EPG_REFRESH_INTERVAL and
+# xml_epg requests are streamed from it, optionally narrowed with
+# channels=id1,id2 and hours=N (programmes airing from now to now+N hours).
+EPG_ENABLED = os.environ.get('EPG_STORE', '0') == '1'
+EPG_ARGS = {'xml_epg', 'channels', 'hours', 'live'}
+EPG_REQUESTS = metrics.Counter('acestream_search_epg_requests_total',
+                               'xml_epg requests by result (store, skipped).', ('result',))
+
+
+def fetch_xmltv():
+    return engine(get_options({'prog': 'epg_store', 'query': '', 'xml_epg': '1'}))
+
+
+def epg_pages():
+    if set(request.args) - EPG_ARGS or not epg_store.ready():
+        EPG_REQUESTS.inc(result='skipped')
+        return None
+    EPG_REQUESTS.inc(result='store')
+    channels = request.args.get('channels')
+    channel_ids = [c.strip() for c in channels.split(',') if c.strip()] if channels else None
+    start = time.time()
+    hours = request.args.get('hours', type=float)
+    return epg_store.xmltv(channel_ids, start, start + hours * 3600 if hours else None)
+
+
+if EPG_ENABLED:
+    epg_store.start_refresher(fetch_xmltv)
+
+
+# Multi-query search: several query= values and/or names run concurrently in
+# a shared bounded pool. Results are merged as each search returns a page,
+# de-duplicated by infohash, and whatever arrived by SEARCH_DEADLINE is served.
+SEARCH_WORKERS = int(os.environ.get('SEARCH_WORKERS', 8))
+SEARCH_MAX_QUERIES = int(os.environ.get('SEARCH_MAX_QUERIES', 16))
+SEARCH_DEADLINE = float(os.environ.get('SEARCH_DEADLINE', 20))
+MULTI_SEARCHES = metrics.Counter('acestream_search_multi_requests_total',
+                                 'Multi-query searches by result (complete, partial).', ('result',))
+
+search_pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix='search')
+
+
+def search_units(args):
+    """One JSON search per query value, or per name when no query is given.
+
+    Names narrow every query's results, as they do for a single search.
+    Returns None for a single plain search.
+    """
+    queries = list(OrderedDict.fromkeys(u_code(q) for q in request.args.getlist('query') if q.strip()))
+    names = list(OrderedDict.fromkeys(n for value in request.args.getlist('name')
+                                      for n in split_quoted(u_code(value))))
+    if args.xml_epg or args.url:
+        return None
+    if len(queries) > 1:
+        pairs = [(query, names or None) for query in queries]
+    elif not queries and len(names) > 1:
+        pairs = [(name, [name]) for name in names]
+    else:
+        return None
+    units = []
+    for query, name in pairs:
+        unit = copy.copy(args)
+        unit.query, unit.name, unit.json = query, name, True
+        units.append(unit)
+    return units[:SEARCH_MAX_QUERIES]
+
+
+def parse_page(page):
+    """Rows from one page of the engine's JSON output (header and footer pages give none)."""
+    body = page.strip().strip(',')
+    if not body or body in ('[', ']'):
+        return []
+    try:
+        return list(channel_index.parse_catalogue(['[%s]' % body]))
+    except ValueError:
+        return []
+
+
+def run_unit(unit, results, cancel):
+    pages = engine(unit)
+    try:
+        for page in pages:
+            if cancel.is_set():
+                break
+            rows = parse_page(page)
+            if rows:
+                results.put(rows)
+    except Exception as e:
+        logger.error('search for %r failed: %s', unit.query, e)
+    finally:
+        pages.close()
+        results.put(None)
+
+
+def merged_rows(units, trace=None):
+    """Yield batches of new rows, ranked, as the searches for units return them.
+
+    Raises PartialResults after the last batch if the deadline cut a search short.
+    """
+    deadline = time.monotonic() + SEARCH_DEADLINE
+    results = queue.Queue()
+    cancel = threading.Event()
+    for unit in units:
+        search_pool.submit(run_unit, unit, results, cancel)
+    seen = set()
+    pending = len(units)
+    try:
+        while pending:
+            try:
+                rows = results.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if rows is None:
+                pending -= 1
+                continue
+            fresh = []
+            for row in rows:
+                if row['infohash'] not in seen:
+                    seen.add(row['infohash'])
+                    fresh.append(row)
+            if fresh:
+                yield sorted(fresh, key=lambda r: -r['availability'])
+    finally:
+        cancel.set()
+    if trace:
+        trace.mark('merged', queries=len(units), unfinished=pending, rows=len(seen))
+    MULTI_SEARCHES.inc(result='partial' if pending else 'complete')
+    if pending:
+        raise PartialResults()
+
+
+def multi_pages(args, units, trace=None):
+    if args.json:
+        rows, partial = [], None
+        try:
+            for batch in merged_rows(units, trace):
+                rows.extend(batch)
+        except PartialResults as e:
+            partial = e
+        rows.sort(key=lambda r: -r['availability'])
+        for page in channel_index.render_json(rows):
+            yield page
+        if partial:
+            raise partial
+        return
+    target = getattr(args, 'target', None) or ENGINE_URL.split('://', 1)[-1]
+    yield '#EXTM3U\n'
+    number = 1
+    for batch in merged_rows(units, trace):
+        for page in channel_index.render_m3u(batch, target, show_epg=bool(args.show_epg),
+                                             group_by_channels=bool(args.group_by_channels),
+                                             start=number, header=False):
+            yield page
+        number += len(batch)
+
+
+def traced(pages, trace):
+    """Mark the first page and finish the trace once the body has been sent."""
+    size = 0
+    try:
+        for page in pages:
+            if not size:
+                trace.mark('first_page')
+            size += len(page)
+            yield page
+    finally:
+        trace.finish(bytes=size)
+
+
 # Use two routing rules of Your choice where playlist extension does matter.
 @app.route('/search.m3u')
 @app.route('/search.m3u8')
 def main():
-    args = get_args()
+    record = log_request(request.path, **request.args.to_dict())
+    trace = tracing.start(request.path, request_id=record['request_id'])
+    try:
+        response = search_response(trace)
+    except Exception:
+        if trace:
+            trace.finish(status=500)
+        raise
+    # Streamed bodies finish their trace in traced(); every other exit finishes it here.
+    if trace and not response.is_streamed:
+        trace.finish(status=response.status_code, bytes=response.calculate_content_length())
+    response.headers['X-Request-Id'] = record['request_id']
+    return response
+
+
+def search_response(trace):
+    with tracing.span('get_args'):
+        args = get_args()
     # return str(args)
     if args.xml_epg:
         content_type = 'text/xml'
@@ -40,7 +602,10 @@ def main():
         content_type = 'application/x-mpegURL'
 
     def generate():
-        for page in engine(args):
+        for number, page in enumerate(engine(args)):
+            # Page 0 is the playlist/XML/JSON header; page 1 is the first upstream result page.
+            if number == 1 and trace:
+                trace.mark('engine_first_page')
             yield page + '\n'
 
     if 'version' in args:
@@ -56,7 +621,50 @@ def main():
         response.headers['Content-Type'] = ''
         response.status_code = 302
         return response
-    return Response(generate(), content_type=content_type)
+    fmt = cache_format(args)
+    base = public_base() if fmt == 'm3u' and REWRITE_URLS else None
+    encoding = accepted_encoding()
+    pages = entry = etag = modified = None
+    live = request.args.get('live') == '1'
+    units = search_units(args)
+    produce = (lambda: multi_pages(args, units, trace)) if units else generate
+    if fmt == 'xml' and EPG_ENABLED and not live:
+        with tracing.span('epg_lookup'):
+            pages = epg_pages()
+    elif INDEX_ENABLED and not live and not units:
+        with tracing.span('index_lookup') as span:
+            pages = index_pages(args)
+            span['hit'] = pages is not None
+        if pages is not None:
+            modified = channel_index.last_crawl()
+            etag = make_etag('index', modified, cache_key(args), base)
+    if pages is None:
+        with tracing.span('cache_lookup') as span:
+            entry, pages = cached_pages(cache_key(args), fmt, produce)
+            span['hit'] = entry is not None
+        if entry:
+            modified = entry['modified']
+            etag = make_etag(entry['digest'], base)
+    if etag and not_modified(etag, modified):
+        response = Response(status=304)
+    else:
+        if entry:
+            pages = cached_body(entry, encoding, base)
+        else:
+            if base:
+                pages = rewrite_lines(pages, base)
+            if encoding:
+                pages = compress_stream(pages, encoding)
+        if trace:
+            pages = traced(pages, trace)
+        response = Response(pages, content_type=content_type)
+    if encoding and response.status_code == 200:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    if etag:
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = formatdate(modified, usegmt=True)
+    return response
 
 
 if __name__ == '__main__':
@@ -0,0 +1,370 @@
+# coding=utf8
+"""control_api.py through the Flask test client, with bench/fake_acestreamengine as the engine."""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WORKDIR = tempfile.mkdtemp(prefix='control_api_test_')
+os.environ.update({
+    'ACESTREAM_BINARY': os.path.join(HERE, 'bench', 'fake_acestreamengine'),
+    'ACESTREAM_PORTS': '17878-17885',
+    'FAKE_ENGINE_BOOT_DELAY': '0.3',
+    'FAKE_ENGINE_LOG_INTERVAL': '0',
+    'REGISTRY_FILE': os.path.join(WORKDIR, 'registry.json'),
+    'TRACE_FILE': os.path.join(WORKDIR, 'traces.jsonl'),
+    'REQUEST_LOG_FILE': os.path.join(WORKDIR, 'requests.jsonl'),
+    'ENGINE_LOG_DIR': os.path.join(WORKDIR, 'logs'),
+    'PINNED_STREAMS': 'pinned',
+})
+
+import control_api  # noqa: E402
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out waiting for condition')
+        time.sleep(0.01)
+
+
+class AdmissionTest(unittest.TestCase):
+    """admit_spawn() ordering, displacement and rejection, without spawning engines."""
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(control_api, 'ADMISSION_MIN_FREE_MB', 0),
+            mock.patch.object(control_api, 'ADMISSION_MAX_LOAD', float('inf')),
+            mock.patch.object(control_api, 'ADMISSION_MAX_STARTING', 1),
+            mock.patch.object(control_api, 'ADMISSION_WAIT', 10),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # One spawn in progress, so every other one has to queue.
+        control_api.admit_spawn('holder', control_api.PRIORITY_NORMAL)
+        self.admitted = []
+        self.rejected = []
+
+    def tearDown(self):
+        with control_api.admission_cond:
+            control_api.admission_state['starting'] = 0
+            del control_api.admission_queue[:]
+            control_api.admission_bumped.clear()
+
+    def queue(self, stream_id, priority=None):
+        def run():
+            try:
+                control_api.admit_spawn(stream_id, control_api.stream_priority(stream_id, priority))
+            except control_api.AdmissionRejected as e:
+                self.rejected.append((stream_id, e.reason, e.retry_after))
+            else:
+                self.admitted.append(stream_id)
+        queued = len(control_api.admission_queue)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        wait_for(lambda: len(control_api.admission_queue) > queued or self.rejected)
+        return thread
+
+    def drain(self, threads):
+        for count in range(1, len(threads) + 1):
+            control_api.release_spawn()
+            wait_for(lambda: len(self.admitted) + len(self.rejected) >= count)
+        for thread in threads:
+            thread.join(5)
+
+    def test_queue_order_by_priority(self):
+        threads = [self.queue('warm', control_api.PRIORITY_PREWARM), self.queue('normal'), self.queue('pinned')]
+        self.drain(threads)
+        self.assertEqual(self.admitted, ['pinned', 'normal', 'warm'])
+        self.assertEqual(self.rejected, [])
+
+    def test_same_priority_is_first_come_first_served(self):
+        threads = [self.queue('first'), self.queue('second'), self.queue('third')]
+        self.drain(threads)
+        self.assertEqual(self.admitted, ['first', 'second', 'third'])
+
+    def test_higher_priority_displaces_tail_of_full_queue(self):
+        with mock.patch.object(control_api, 'ADMISSION_QUEUE_SIZE', 2):
+            threads = [self.queue('first'), self.queue('second')]
+            threads.append(self.queue('pinned'))
+            wait_for(lambda: self.rejected)
+            self.assertEqual([r[:2] for r in self.rejected], [('second', 'admission queue full')])
+            # Lower priority than everything queued: rejected straight away.
+            self.queue('warm', control_api.PRIORITY_PREWARM)
+            wait_for(lambda: len(self.rejected) == 2)
+            self.assertEqual(self.rejected[1][:2], ('warm', 'admission queue full'))
+            self.assertGreaterEqual(self.rejected[1][2], 1)
+            control_api.release_spawn()
+            wait_for(lambda: self.admitted == ['pinned'])
+            control_api.release_spawn()
+            wait_for(lambda: self.admitted == ['pinned', 'first'])
+        for thread in threads:
+            thread.join(5)
+
+    def test_failing_resource_check_leaves_the_queue(self):
+        control_api.release_spawn()
+        with mock.patch.object(control_api, 'admission_blocker', side_effect=OSError('no loadavg')):
+            self.assertRaises(OSError, control_api.admit_spawn, 'broken', control_api.PRIORITY_NORMAL)
+        self.assertEqual(control_api.admission_queue, [])
+        control_api.admit_spawn('next', control_api.PRIORITY_NORMAL)
+
+    def test_failed_engines_do_not_count_as_running(self):
+        failed = {'stream_id': 'failed', 'state': control_api.STATE_FAILED, 'pid': os.getpid(), 'port': None,
+                  'process': None, 'failed_at': time.time()}
+        with control_api.streams_lock:
+            control_api.active_streams['failed'] = failed
+        self.addCleanup(control_api.active_streams.pop, 'failed', None)
+        self.assertEqual(control_api.running_engines(), 0)
+        with mock.patch.object(control_api, 'ADMISSION_MAX_ENGINES', 1):
+            self.assertIsNone(control_api.admission_blocker())
+
+    def test_full_queue_returns_503_with_retry_after(self):
+        client = control_api.app.test_client()
+        with mock.patch.object(control_api, 'ADMISSION_QUEUE_SIZE', 0):
+            response = client.post('/start_stream', json={'stream_id': 'rejected', 'async': False})
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        self.assertEqual(response.json['retry_after'], int(response.headers['Retry-After']))
+        self.assertNotIn('rejected', control_api.active_streams)
+
+
+class StartStreamTest(unittest.TestCase):
+    """Engine starts against the fake engine."""
+
+    def setUp(self):
+        self.client = control_api.app.test_client()
+
+    def tearDown(self):
+        for stream_id in list(control_api.active_streams):
+            control_api.release_stream(stream_id)
+
+    def start(self, stream_id, results):
+        response = self.client.post('/start_stream', json={'stream_id': stream_id, 'async': False})
+        results.append((response.status_code, response.json))
+
+    def test_concurrent_starts_share_one_engine(self):
+        results = []
+        threads = [threading.Thread(target=self.start, args=('shared', results)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual([status for status, _ in results], [200] * 4)
+        self.assertEqual(len({payload['pid'] for _, payload in results}), 1)
+        self.assertTrue(all(payload['ready'] for _, payload in results))
+        self.assertEqual(sum(1 for _, payload in results if payload.get('coalesced') or payload.get('reused')), 3)
+
+    def test_full_pool_evicts_least_recently_used(self):
+        results = []
+        with mock.patch.object(control_api, 'ENGINE_PORTS', control_api.ENGINE_PORTS[:2]), \
+                mock.patch.object(control_api, 'POOL_SIZE', 2):
+            for stream_id in ('first', 'second', 'third'):
+                self.start(stream_id, results)
+        self.assertEqual([status for status, _ in results], [200] * 3)
+        self.assertEqual(results[2][1]['method'], 'acestream-engine')
+        self.assertEqual(list(control_api.active_streams), ['second', 'third'])
+        self.assertFalse(control_api.psutil.pid_exists(results[0][1]['pid']))
+        self.assertEqual(results[2][1]['port'], results[0][1]['port'])
+
+    def test_batch_beyond_free_pool_is_rejected_without_eviction(self):
+        results = []
+        with mock.patch.object(control_api, 'ENGINE_PORTS', control_api.ENGINE_PORTS[:2]), \
+                mock.patch.object(control_api, 'POOL_SIZE', 2):
+            self.start('viewer', results)
+            response = self.client.post('/start_streams', json={'stream_ids': ['g0', 'g1', 'g2']})
+        self.assertEqual(response.status_code, 207)
+        batch = response.json
+        self.assertEqual(list(batch['results']), ['g0', 'g1', 'g2'])
+        self.assertEqual(batch['results']['g0']['status'], 'started')
+        self.assertEqual([batch['results'][s]['status'] for s in ('g1', 'g2')], ['rejected', 'rejected'])
+        self.assertEqual((batch['succeeded'], batch['failed'], batch['pending']), (1, 2, 0))
+        self.assertEqual(sorted(control_api.active_streams), ['g0', 'viewer'])
+
+    def test_start_is_async_by_default(self):
+        response = self.client.post('/start_stream', json={'stream_id': 'job'})
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json['status_url']
+        wait_for(lambda: self.client.get(status_url).json['state'] in control_api.JOB_TERMINAL_STATES, 30)
+        job = self.client.get(status_url).json
+        self.assertEqual((job['state'], job['result']['stream_id']), ('ready', 'job'))
+
+    def test_async_flag_is_parsed_as_boolean(self):
+        results = []
+        for value in ('0', 'false', 0):
+            response = self.client.post('/start_stream', json={'stream_id': 'sync', 'async': value})
+            results.append(response.status_code)
+        response = self.client.post('/start_stream', json={'stream_id': 'sync', 'async': 'maybe'})
+        self.assertEqual(results, [200] * 3)
+        self.assertEqual(response.status_code, 400)
+
+    def test_ready_marker_in_engine_output(self):
+        results = []
+        with mock.patch.dict(os.environ, {'FAKE_ENGINE_BOOT_DELAY': '5'}), \
+                mock.patch.object(control_api, 'ENGINE_READY_MARKERS', ['starting fake engine']):
+            self.start('marker', results)
+        status, payload = results[0]
+        self.assertEqual((status, payload['method'], payload['ready']), (200, 'acestream-engine', True))
+        self.assertLess(payload['time_to_ready'], 4)
+
+    def test_engine_not_ready_in_time_is_stopped(self):
+        results = []
+        with mock.patch.dict(os.environ, {'FAKE_ENGINE_BOOT_DELAY': '5'}), \
+                mock.patch.object(control_api, 'ENGINE_READY_TIMEOUT', 0.5):
+            self.start('hung', results)
+        self.assertEqual(results[0][1]['method'], 'fallback')
+        entry = control_api.active_streams['hung']
+        self.assertEqual((entry['state'], entry['port']), (control_api.STATE_FAILED, None))
+        self.assertFalse(control_api.psutil.pid_exists(entry['pid']))
+
+    def test_relay_shares_one_upstream_between_viewers(self):
+        results = []
+        with mock.patch.dict(os.environ, {'FAKE_ENGINE_BITRATE': '4000000'}):
+            self.start('relayed', results)
+        self.assertEqual(self.client.get('/relay/unknown').status_code, 404)
+        viewers = [self.client.get('/relay/relayed', buffered=False) for _ in range(2)]
+        try:
+            for viewer in viewers:
+                chunk = next(viewer.response)
+                self.assertEqual(len(chunk) % control_api.TS_PACKET_SIZE, 0)
+                self.assertEqual(chunk[:1], b'\x47')
+            relays = self.client.get('/relays').json
+            self.assertEqual(list(relays), ['relayed'])
+            self.assertEqual((relays['relayed']['clients'], relays['relayed']['reconnects']), (2, 0))
+        finally:
+            for viewer in viewers:
+                viewer.close()
+        self.assertEqual(control_api.relays['relayed']['clients'], 0)
+
+    def test_restart_readopts_surviving_engines(self):
+        results = []
+        for stream_id in ('kept', 'dead'):
+            self.start(stream_id, results)
+        control_api.persist_registry(force=True)
+        with open(control_api.REGISTRY_FILE) as f:
+            saved = control_api.json.load(f)
+        self.assertEqual(sorted(info['stream_id'] for info in saved['streams']), ['dead', 'kept'])
+        self.assertFalse(any('last_access' in info for info in saved['streams']))
+        # A restart: the registry is lost and one engine dies while the API is down.
+        with control_api.streams_lock:
+            entries = dict(control_api.active_streams)
+            control_api.active_streams.clear()
+        os.killpg(entries['dead']['pid'], control_api.signal.SIGTERM)
+        entries['dead']['process'].wait(5)
+        self.assertEqual(control_api.restore_registry(), 1)
+        kept = control_api.active_streams['kept']
+        started = results[0][1]
+        self.assertEqual((kept['pid'], kept['port'], kept['reattached']), (started['pid'], started['port'], True))
+        self.assertIsInstance(kept['process'], control_api.AdoptedProcess)
+        self.assertNotIn('dead', control_api.active_streams)
+        payload, status = control_api.launch_stream('kept')
+        self.assertEqual((status, payload['pid'], payload.get('reused')), (200, kept['pid'], True))
+
+    def test_reaper_stops_only_streams_without_viewers(self):
+        results = []
+        for stream_id in ('idle', 'watched', 'pinned'):
+            self.start(stream_id, results)
+        for entry in control_api.active_streams.values():
+            entry['last_access'] -= control_api.IDLE_GRACE + 1
+        viewer = control_api.socket.create_connection(('127.0.0.1', results[1][1]['port']))
+        try:
+            reaped = control_api.reap_idle_streams()
+        finally:
+            viewer.close()
+        self.assertEqual(reaped, ['idle'])
+        self.assertEqual(sorted(control_api.active_streams), ['pinned', 'watched'])
+        self.assertLess(time.time() - control_api.active_streams['watched']['last_access'], 5)
+
+    def test_stop_unknown_stream_is_not_found(self):
+        results = []
+        self.start('running', results)
+        response = self.client.post('/stop_stream', json={'stream_id': 'unknown'})
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('running', control_api.active_streams)
+
+
+class PrewarmTest(unittest.TestCase):
+    """prewarm_cycle() against a synthetic request history."""
+
+    def setUp(self):
+        now = time.time() + control_api.PREWARM_LEAD
+        history = [{'stream_id': stream_id, 'timestamp': now} for stream_id in ('popular', 'popular', 'rare')]
+        patches = [
+            mock.patch.object(control_api, 'read_requests', return_value=history),
+            mock.patch.object(control_api, 'PREWARM_TOP_K', 1),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        for stream_id in list(control_api.active_streams):
+            control_api.release_stream(stream_id)
+        control_api.prewarm_retired.clear()
+
+    def test_predicted_stream_is_started_and_handed_to_the_first_viewer(self):
+        control_api.prewarm_cycle()
+        self.assertEqual(list(control_api.active_streams), ['popular'])
+        self.assertTrue(control_api.active_streams['popular']['prewarmed'])
+        payload, status = control_api.launch_stream('popular')
+        self.assertEqual((status, payload.get('reused')), (200, True))
+        self.assertFalse(control_api.active_streams['popular']['prewarmed'])
+
+    def test_unwatched_prewarmed_stream_is_retired(self):
+        control_api.prewarm_cycle()
+        control_api.active_streams['popular']['last_access'] -= control_api.PREWARM_IDLE + 1
+        control_api.prewarm_cycle()
+        self.assertNotIn('popular', control_api.active_streams)
+        self.assertIn('popular', control_api.prewarm_retired)
+
+
+class DaemonTest(unittest.TestCase):
+    """Stream sessions on one shared fake engine (ACESTREAM_MODE=daemon)."""
+
+    def setUp(self):
+        self.client = control_api.app.test_client()
+        patches = [
+            mock.patch.object(control_api, 'ENGINE_MODE', 'daemon'),
+            mock.patch.object(control_api, 'DAEMON_PORT', 17886),
+            mock.patch.object(control_api, 'DAEMON_LOG_FILE', os.path.join(WORKDIR, 'daemon.log')),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        for stream_id in list(control_api.active_streams):
+            control_api.release_stream(stream_id)
+        process = control_api.daemon_state['process']
+        if process is not None and process.poll() is None:
+            os.killpg(process.pid, control_api.signal.SIGTERM)
+            process.wait(5)
+        control_api.daemon_state.update({'process': None, 'restarts': 0, 'started_at': None})
+
+    def start(self, stream_id):
+        response = self.client.post('/start_stream', json={'stream_id': stream_id, 'async': False})
+        self.assertEqual(response.status_code, 200)
+        return response.json
+
+    def stop(self, stream_id):
+        return self.client.post('/stop_stream', json={'stream_id': stream_id}).json
+
+    def test_sessions_are_reference_counted(self):
+        first, second = self.start('shared'), self.start('shared')
+        other = self.start('other')
+        self.assertEqual(first['method'], 'acestream-daemon')
+        self.assertEqual((first['refcount'], second['refcount']), (1, 2))
+        self.assertEqual({first['pid'], second['pid'], other['pid']}, {control_api.daemon_state['process'].pid})
+        self.assertEqual(self.stop('shared'), {'status': 'released', 'stream_id': 'shared', 'refcount': 1})
+        self.assertEqual(self.stop('shared'), {'status': 'stopped', 'stream_id': 'shared'})
+        self.assertNotIn('shared', control_api.active_streams)
+        self.assertIn('other', control_api.active_streams)
+        self.assertTrue(control_api.daemon_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
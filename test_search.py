@@ -0,0 +1,172 @@
+# coding=utf8
+"""search.py through the Flask test client, with bench/stubs/acestream_search as the engine."""
+import os
+import re
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WORKDIR = tempfile.mkdtemp(prefix='search_test_')
+sys.path.insert(0, os.path.join(HERE, 'bench', 'stubs'))
+os.environ.update({
+    'BENCH_SEARCH_RESULTS': '100',
+    'TRACE_FILE': os.path.join(WORKDIR, 'traces.jsonl'),
+    'REQUEST_LOG_FILE': os.path.join(WORKDIR, 'requests.jsonl'),
+})
+
+import search  # noqa: E402
+
+CATEGORIES = ('news', 'sport', 'movies', 'music', 'kids')
+
+
+def stub_names(*queries):
+    """Channel names the stub returns for any of the queries."""
+    names = ['Channel %d %s' % (i, CATEGORIES[i % 5]) for i in range(int(os.environ['BENCH_SEARCH_RESULTS']))]
+    return {name for name in names if any(query.lower() in name.lower() for query in queries)}
+
+
+def playlist_names(body):
+    return re.findall(r'^#EXTINF:[^,]*,\d+\. (.*)$', body, re.M)
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = search.app.test_client()
+        env = mock.patch.dict(os.environ, {'BENCH_SEARCH_PAGE_SIZE': '10', 'BENCH_SEARCH_LATENCY': '0'})
+        env.start()
+        self.addCleanup(env.stop)
+        with search.cache_lock:
+            search.cache.clear()
+            search.cache_size[0] = 0
+
+    def counted(self, name, labels):
+        return getattr(search, name).values.get(labels, 0)
+
+
+class SingleFlightTest(SearchTest):
+
+    def test_concurrent_misses_run_one_search(self):
+        gate = threading.Event()
+        calls = []
+
+        def produce():
+            calls.append(1)
+            yield 'first'
+            gate.wait(5)
+            yield 'second'
+
+        key = ('/search.m3u', ('query', 'coalesced'))
+        coalesced = self.counted('CACHE_REQUESTS', ('coalesced',))
+        followers = [search.cached_pages(key, 'm3u', produce) for _ in range(3)]
+        self.assertEqual([entry for entry, _ in followers], [None] * 3)
+        self.assertEqual(self.counted('CACHE_REQUESTS', ('coalesced',)) - coalesced, 2)
+        gate.set()
+        self.assertEqual([list(pages) for _, pages in followers], [['first', 'second']] * 3)
+        self.assertEqual(len(calls), 1)
+        entry, pages = search.cached_pages(key, 'm3u', produce)
+        self.assertEqual(entry['pages'], ['first', 'second'])
+        self.assertEqual(list(pages), ['first', 'second'])
+        self.assertEqual(len(calls), 1)
+
+    def test_failed_search_reaches_every_follower(self):
+        def produce():
+            yield 'first'
+            raise RuntimeError('engine failed')
+
+        flight = search.Flight()
+        search.fill(('/search.m3u', ('query', 'failed')), 'm3u', produce, flight)
+        for _ in range(2):
+            pages = flight.follow()
+            self.assertEqual(next(pages), 'first')
+            self.assertRaises(RuntimeError, next, pages)
+        self.assertNotIn(('/search.m3u', ('query', 'failed')), search.cache)
+
+    def test_concurrent_requests_share_one_engine_call(self):
+        calls = []
+
+        def engine(args):
+            calls.append(args.query)
+            return stub(args)
+
+        stub = search.engine
+        results = []
+        with mock.patch.dict(os.environ, {'BENCH_SEARCH_LATENCY': '0.1'}), \
+                mock.patch.object(search, 'engine', engine):
+            threads = [threading.Thread(target=lambda: results.append(self.client.get('/search.m3u?query=sport')))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+        self.assertEqual(calls, ['sport'])
+        bodies = {response.get_data(as_text=True) for response in results}
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(set(playlist_names(bodies.pop())), stub_names('sport'))
+
+    def test_equivalent_requests_share_a_cache_entry(self):
+        calls = []
+
+        def engine(args):
+            calls.append(args.query)
+            return stub(args)
+
+        stub = search.engine
+        with mock.patch.object(search, 'engine', engine):
+            first = self.client.get('/search.m3u?query=sport&json=1').get_data(as_text=True)
+            second = self.client.get('/search.m3u8?json=true&query=sport',
+                                     headers={'Host': 'other.example'}).get_data(as_text=True)
+            self.client.get('/search.m3u?query=news&json=1').get_data()
+        self.assertEqual(first, second)
+        self.assertEqual(calls, ['sport', 'news'])
+        self.assertEqual(len(search.cache), 2)
+
+
+class MultiQueryTest(SearchTest):
+
+    def test_results_are_merged_without_duplicates(self):
+        complete = self.counted('MULTI_SEARCHES', ('complete',))
+        body = self.client.get('/search.m3u?query=Channel 1&query=sport').get_data(as_text=True)
+        names = playlist_names(body)
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(set(names), stub_names('Channel 1', 'sport'))
+        self.assertEqual(self.counted('MULTI_SEARCHES', ('complete',)) - complete, 1)
+        self.assertEqual(len(search.cache), 1)
+
+    def test_name_narrows_every_query(self):
+        body = self.client.get('/search.m3u?query=Channel 1&query=Channel 2&name=%22Channel 12 movies%22')
+        self.assertEqual(playlist_names(body.get_data(as_text=True)), ['Channel 12 movies'])
+
+    def test_deadline_serves_partial_results_uncached(self):
+        partial = self.counted('MULTI_SEARCHES', ('partial',))
+        with mock.patch.dict(os.environ, {'BENCH_SEARCH_PAGE_SIZE': '1', 'BENCH_SEARCH_LATENCY': '0.1'}), \
+                mock.patch.object(search, 'SEARCH_DEADLINE', 0.35):
+            body = self.client.get('/search.m3u?query=Channel 1&query=Channel 2').get_data(as_text=True)
+        names = playlist_names(body)
+        self.assertTrue(body.startswith('#EXTM3U'))
+        self.assertTrue(names)
+        self.assertLess(len(names), len(stub_names('Channel 1', 'Channel 2')))
+        self.assertTrue(set(names) <= stub_names('Channel 1', 'Channel 2'))
+        self.assertEqual(self.counted('MULTI_SEARCHES', ('partial',)) - partial, 1)
+        self.assertEqual(len(search.cache), 0)
+
+
+class TraceTest(SearchTest):
+
+    def test_every_exit_finishes_the_trace(self):
+        records = []
+        urls = ('/search.m3u?version=1', '/search.m3u?help=1', '/search.m3u?usage=1',
+                '/search.m3u?query=sport&url=1')
+        with mock.patch.object(search.tracing, '_enqueue', records.append):
+            for url in urls:
+                response = self.client.get(url)
+                self.assertIn('X-Request-Id', response.headers)
+                self.assertIsNone(search.tracing.current())
+        self.assertEqual([r['status'] for r in records if r['span'] == 'request'], [200, 200, 200, 302])
+
+
+if __name__ == '__main__':
+    unittest.main()
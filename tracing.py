@@ -0,0 +1,161 @@
+"""Lightweight request tracing shared by control_api.py and search.py.
+
+A trace is started per request (subject to TRACE_SAMPLE) and each phase is
+recorded as a span. Spans are queued and written by a background thread to a
+size-rotated JSONL file, one object per line keyed by request_id like
+request_log.py, so the request path never waits on disk.
+"""
+import contextlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+
+TRACE_FILE = os.environ.get('TRACE_FILE', '/tmp/acestream_traces.jsonl')
+TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', 10 * 1024 * 1024))
+TRACE_SAMPLE = float(os.environ.get('TRACE_SAMPLE', 1.0))
+TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', 10000))
+
+_queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+_local = threading.local()
+_writer = []
+_writer_lock = threading.Lock()
+stats = {'written': 0, 'dropped': 0}
+
+
+class Trace(object):
+    def __init__(self, route, request_id=None, **fields):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.route = route
+        self.fields = fields
+        self.started = time.time()
+        self.t0 = time.monotonic()
+        self.stack = []
+        self.finished = False
+
+    def emit(self, name, started, duration, **fields):
+        record = {'request_id': self.request_id, 'timestamp': started, 'route': self.route, 'span': name,
+                  'offset_ms': round((started - self.started) * 1000, 3),
+                  'duration_ms': round(duration * 1000, 3)}
+        if self.stack:
+            record['parent'] = self.stack[-1]
+        record.update(fields)
+        _enqueue(record)
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        started, t0 = time.time(), time.monotonic()
+        self.stack.append(name)
+        error = None
+        try:
+            yield fields
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.stack.pop()
+            if error:
+                fields['error'] = error
+            self.emit(name, started, time.monotonic() - t0, **fields)
+
+    def mark(self, name, **fields):
+        """Zero-length span at this point; its offset_ms is the time since the trace started."""
+        self.emit(name, time.time(), 0, **fields)
+
+    def finish(self, **fields):
+        if self.finished:
+            return
+        self.finished = True
+        self.stack = []
+        fields.update(self.fields)
+        self.emit('request', self.started, time.monotonic() - self.t0, **fields)
+        if current() is self:
+            _local.trace = None
+
+
+def new(route, request_id=None, **fields):
+    """A sampled Trace, or None; not bound to any thread (see activate())."""
+    if TRACE_SAMPLE >= 1 or random.random() < TRACE_SAMPLE:
+        return Trace(route, request_id, **fields)
+    return None
+
+
+def start(route, request_id=None, **fields):
+    """Begin a trace for the current thread, or return None when not sampled."""
+    trace = _local.trace = new(route, request_id, **fields)
+    return trace
+
+
+def current():
+    return getattr(_local, 'trace', None)
+
+
+@contextlib.contextmanager
+def activate(trace):
+    """Make trace current in this thread (e.g. a worker running for a request)."""
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """Record a span on the current trace; a no-op when there is none."""
+    trace = current()
+    if trace is None:
+        yield fields
+        return
+    with trace.span(name, **fields) as fields:
+        yield fields
+
+
+def mark(name, **fields):
+    """Zero-length span on the current trace, if any."""
+    trace = current()
+    if trace is not None:
+        trace.mark(name, **fields)
+
+
+def _enqueue(record):
+    if not _writer:
+        with _writer_lock:
+            if not _writer:
+                thread = threading.Thread(target=_write_loop, name='trace-writer', daemon=True)
+                thread.start()
+                _writer.append(thread)
+    try:
+        _queue.put_nowait(record)
+    except queue.Full:
+        stats['dropped'] += 1
+
+
+def _write_loop():
+    while True:
+        records = [_queue.get()]
+        while len(records) < 1000:
+            try:
+                records.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        data = ''.join(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in records)
+        try:
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_MAX_BYTES:
+                os.replace(TRACE_FILE, TRACE_FILE + '.1')
+            with open(TRACE_FILE, 'a') as f:
+                f.write(data)
+            stats['written'] += len(records)
+        except OSError:
+            stats['dropped'] += len(records)
+
+
+def flush(timeout=5):
+    """Wait until queued spans have been handed to the writer (for tests and shutdown)."""
+    deadline = time.monotonic() + timeout
+    while not _queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)